@@ -0,0 +1,83 @@
+import os
+import re
+from collections import Counter, namedtuple
+
+# album level decisions, made once from every track of an album folder
+# and shared by the per-track fixes
+# various     - 1 when any track marks the album as a compilation
+# albumartist - the album artist most tracks agree on, None if various
+# discnumber, disctotal, tracktotal - 0 when they cannot be worked out
+
+AlbumContext = namedtuple('AlbumContext',
+                          'folder various albumartist discnumber disctotal tracktotal')
+
+DISC_FOLDER = re.compile(r'(?:disc|disk|cd)\s*(\d+)\s*$', re.IGNORECASE)
+
+
+def _first(comment, key):
+    values = comment.get(key)
+    return values[0] if values else None
+
+
+def _number(value):
+    # '3', '03' and '3/12' all count
+    try:
+        return int(str(value).split('/')[0])
+    except (TypeError, ValueError):
+        return 0
+
+
+def is_compilation(comment):
+    # one track's say, shared by the per-track and the album fixes: a
+    # COMPILATION flag or an album artist naming Various Artists
+    if _first(comment, 'COMPILATION') in ('1', 'True', 'Y'):
+        return True
+    for key in ('ALBUMARTIST', 'ALBUM ARTIST'):
+        value = _first(comment, key)
+        if value and 'various' in value.lower():
+            return True
+    return False
+
+
+def album_context(folder, comments):
+    # comments is one tag mapping per track in the folder
+
+    various = int(any(is_compilation(comment) for comment in comments))
+
+    albumartist = None
+    if not various:
+        votes = Counter(_first(comment, 'ALBUMARTIST') or _first(comment, 'ALBUM ARTIST')
+                        for comment in comments)
+        votes.pop(None, None)
+        if not votes:
+            # fall back to an artist every track shares
+            votes = Counter(_first(comment, 'ARTIST') for comment in comments)
+            votes.pop(None, None)
+            if len(votes) != 1:
+                votes = Counter()
+        if votes:
+            albumartist = votes.most_common(1)[0][0]
+
+    # Album/Disc 2 style folders carry the disc number, their siblings
+    # the total
+    discnumber = disctotal = 0
+    disc_folder = DISC_FOLDER.search(os.path.basename(os.path.normpath(folder)))
+    if disc_folder:
+        discnumber = int(disc_folder.group(1))
+        parent = os.path.dirname(os.path.normpath(folder))
+        try:
+            with os.scandir(parent) as it:
+                disctotal = sum(1 for entry in it
+                                if entry.is_dir() and DISC_FOLDER.search(entry.name))
+        except OSError:
+            pass
+    tagged_numbers = {_number(_first(comment, 'DISCNUMBER')) for comment in comments}
+    tagged_totals = {_number(_first(comment, 'DISCTOTAL')) for comment in comments}
+    if not discnumber and len(tagged_numbers - {0}) == 1:
+        discnumber = (tagged_numbers - {0}).pop()
+    disctotal = max([disctotal, discnumber] + list(tagged_totals))
+
+    tracktotal = max([len(comments)] +
+                     [_number(_first(comment, 'TRACKNUMBER')) for comment in comments])
+
+    return AlbumContext(folder, various, albumartist, discnumber, disctotal, tracktotal)
@@ -0,0 +1,139 @@
+import io
+import os
+import struct
+import hashlib
+import logging
+from collections import defaultdict
+from metaflac import MetaFlac
+from safewrite import atomic_write
+from verify import meta_audio_digest
+
+logger = logging.getLogger('fixflactag.artwork')
+
+# embedded artwork dedupe, a picture every FLAC of an album folder
+# carries is written once to folder.jpg (folder.png) and its PICTURE
+# blocks dropped, optionally leaving a small thumbnail embedded instead
+# the thumbnail needs Pillow, without it the pictures are just dropped
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+FOLDER_IMAGES = {b'image/jpeg': 'folder.jpg',
+                 b'image/jpg': 'folder.jpg',
+                 b'image/png': 'folder.png'}
+
+FRONT_COVER = 3
+
+
+def picture_digest(filename, data_offset, data_length, chunk=1 << 20):
+    # streamed, a picture is never held in memory whole
+    digest = hashlib.blake2b(digest_size=16)
+    with io.open(filename, 'rb') as file:
+        file.seek(data_offset)
+        while data_length > 0:
+            data = file.read(min(chunk, data_length))
+            if not data:
+                break
+            digest.update(data)
+            data_length -= len(data)
+    return digest.hexdigest()
+
+
+def file_digest(filename):
+    with io.open(filename, 'rb') as file:
+        return picture_digest(filename, 0, os.fstat(file.fileno()).st_size)
+
+
+def read_picture_data(filename, picture):
+    with io.open(filename, 'rb') as file:
+        file.seek(picture['data_offset'])
+        return file.read(picture['data_length'])
+
+
+def thumbnail_block(data, size):
+    # a front cover PICTURE block holding a size x size bound JPEG
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((size, size))
+    out = io.BytesIO()
+    image.convert('RGB').save(out, 'JPEG', quality=85)
+    data = out.getvalue()
+    mime = b'image/jpeg'
+    return (struct.pack('>II', FRONT_COVER, len(mime)) + mime +
+            struct.pack('>I', 0) +
+            struct.pack('>5I', image.width, image.height, 24, 0, len(data)) + data)
+
+
+def write_folder_image(path, data, like):
+    # with the mode of the track like
+    with atomic_write(path, like=like) as out:
+        out.write(data)
+
+
+def dedupe_album_artwork(folder, paths, thumbnail=0, padding=8192, max_padding=65536,
+                         digests=None, verify_samples=0):
+    # returns (bytes reclaimed, files changed)
+    # digests, when given, gets the audio digest of every file written
+    # from before its write, for the caller to check afterwards
+    flacs = dict()
+    # digest -> [(path, picture)]
+    found = defaultdict(list)
+    for path in paths:
+        if not path.lower().endswith('.flac'):
+            continue
+        flacs[path] = metaflac = MetaFlac(path)
+        for picture in metaflac.get_picture_blocks():
+            digest = picture_digest(path, picture['data_offset'], picture['data_length'])
+            found[digest].append((path, picture))
+
+    # a picture in two or more tracks is a duplicate, the front cover
+    # shared by the most tracks goes to the folder image
+    shared = []
+    for digest, carriers in found.items():
+        tracks = len({path for path, _ in carriers})
+        picture = carriers[0][1]
+        if tracks > 1 and picture['mime'].lower() in FOLDER_IMAGES:
+            shared.append((picture['picture_type'] == FRONT_COVER, tracks, digest))
+    if not shared:
+        logger.debug(f'No shared artwork in "{folder}"')
+        return 0, 0
+    _, _, digest = max(shared)
+    carriers = found[digest]
+    first_path, first_picture = carriers[0]
+
+    folder_image = os.path.join(folder, FOLDER_IMAGES[first_picture['mime'].lower()])
+    if os.path.exists(folder_image):
+        if file_digest(folder_image) != digest:
+            logger.warning(f'Keeping embedded artwork, "{folder_image}" is a different picture')
+            return 0, 0
+    else:
+        data = read_picture_data(first_path, first_picture)
+        write_folder_image(folder_image, data, first_path)
+        logger.debug(f'Write "{folder_image}"')
+
+    thumb = None
+    if thumbnail:
+        if Image is None:
+            logger.warning('Pillow is not installed, no thumbnails are embedded')
+        else:
+            thumb = thumbnail_block(read_picture_data(first_path, first_picture), thumbnail)
+
+    reclaimed = changed = 0
+    by_path = defaultdict(list)
+    for path, picture in carriers:
+        by_path[path].append(picture)
+    for path, pictures in sorted(by_path.items()):
+        metaflac = flacs[path]
+        before = os.path.getsize(path)
+        for picture in pictures:
+            metaflac.remove_block(picture['offset'])
+        if thumb:
+            metaflac.add_block(6, thumb)
+        if digests is not None:
+            digests[path] = meta_audio_digest(metaflac, verify_samples)
+        metaflac.save(padding=padding, max_padding=max_padding)
+        logger.debug(f'Delete {len(pictures)} PICTURE blocks on "{path}"')
+        reclaimed += before - os.path.getsize(path)
+        changed += 1
+    return reclaimed, changed
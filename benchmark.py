@@ -0,0 +1,352 @@
+#/usr/bin/python3
+
+# benchmark harness for MetaFlac parsing, rule evaluation and end to end
+# fixflactag runs over a synthetic FLAC/DSF corpus
+#
+#   python3 benchmark.py --sizes 1000,10000 --picture 1048576 --id3
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import struct
+import argparse
+import resource
+import tempfile
+import subprocess
+from metaflac import MetaFlac
+from metadsf import MetaDsf
+from rules import RuleSet
+from prefetch import prefetch_headers
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# a handful of frame-ish bytes, nothing ever decodes the audio
+DUMMY_AUDIO = b'\xff\xf8\x69\x08' + bytes(range(256)) * 4
+
+GENRES = ('Jazz', 'Rock', 'Soul', 'Blues', 'Classical')
+
+
+def _flac_block(block_type, payload, last=False):
+    return struct.pack('>I', (int(last) << 31) | (block_type << 24) | len(payload)) + payload
+
+
+def _streaminfo(samples=44100 * 180, sample_rate=44100, bits=16, channels=2):
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | samples
+    return (struct.pack('>HH', 4096, 4096) + b'\x00\x00\x10\x00\x40\x00' +
+            struct.pack('>Q', packed) + os.urandom(16))
+
+
+def _picture(size):
+    mime = b'image/jpeg'
+    data = b'\xff\xd8' + bytes(max(size - 2, 0))
+    return (struct.pack('>II', 3, len(mime)) + mime + struct.pack('>I', 0) +
+            struct.pack('>IIIII', 500, 500, 24, 0, len(data)) + data)
+
+
+def _id3v2(body):
+    size = len(body)
+    return (b'ID3\x04\x00\x00' +
+            bytes(((size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f)) +
+            body)
+
+
+def _id3_text_frame(frame_id, text):
+    payload = b'\x03' + text.encode('utf-8')
+    size = len(payload)
+    return (frame_id.encode('latin-1') +
+            bytes(((size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f)) +
+            b'\x00\x00' + payload)
+
+
+def make_comments(track, album, comments=20, value_length=16, multi_values=0):
+    # a realistic spread of keys plus filler to reach the comment count
+    filler = 'x' * value_length
+    artist = f'Artist {album:05d}'
+    if multi_values:
+        artist = ';'.join(f'{artist} {n}' for n in range(multi_values + 1))
+    user_comments = [f'ARTIST={artist}',
+                     f'TITLE=Title {track:02d} {filler}',
+                     f'ALBUM=Album {album:05d} [CAT {album:05d}]',
+                     f'GENRE={GENRES[album % len(GENRES)]}',
+                     f'TRACKNUMBER={track:02d}',
+                     'DATE=1999',
+                     'COMMENT=ffz',
+                     'CONTACT=VinylStudio']
+    for n in range(len(user_comments), comments):
+        user_comments.append(f'EXTRA{n}={filler}')
+    return user_comments[:max(comments, 1)]
+
+
+def make_flac(filename, user_comments, picture=0, padding=8192, id3=False):
+    vendor = b'reference libFLAC 1.3.2'
+    comment = [struct.pack('<I', len(vendor)), vendor, struct.pack('<I', len(user_comments))]
+    for user_comment in user_comments:
+        user_comment = user_comment.encode('utf-8')
+        comment += [struct.pack('<I', len(user_comment)), user_comment]
+    blocks = [(0, _streaminfo()),
+              (3, struct.pack('>QQH', 0, 0, 4096) * 4),
+              (4, b''.join(comment))]
+    if picture:
+        blocks.append((6, _picture(picture)))
+    if padding:
+        blocks.append((1, bytes(padding)))
+    with open(filename, 'wb') as file:
+        if id3:
+            file.write(_id3v2(_id3_text_frame('TIT2', 'junk')))
+        file.write(b'fLaC')
+        for idx, (block_type, payload) in enumerate(blocks):
+            file.write(_flac_block(block_type, payload, idx == len(blocks) - 1))
+        file.write(DUMMY_AUDIO)
+
+
+def make_dsf(filename, track, album, value_length=16, picture=0):
+    frames = [_id3_text_frame('TIT2', f'Title {track:02d} ' + 'x' * value_length),
+              _id3_text_frame('TPE1', f'Artist {album:05d}'),
+              _id3_text_frame('TALB', f'Album {album:05d}'),
+              _id3_text_frame('TENC', 'VinylStudio'),
+              _id3_text_frame('TDRC', '1999')]
+    if picture:
+        data = b'\x00image/jpeg\x00\x03\x00' + bytes(picture)
+        size = len(data)
+        frames.append(b'APIC' +
+                      bytes(((size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f)) +
+                      b'\x00\x00' + data)
+    tag = _id3v2(b''.join(frames))
+    # stereo DSD64, 1 bit samples
+    fmt = b'fmt ' + struct.pack('<QIIIIIIQII', 52, 1, 0, 2, 2, 2822400, 1,
+                                len(DUMMY_AUDIO) * 4, 4096, 0)
+    data = b'data' + struct.pack('<Q', 12 + len(DUMMY_AUDIO)) + DUMMY_AUDIO
+    metadata_offset = 28 + len(fmt) + len(data)
+    with open(filename, 'wb') as file:
+        file.write(b'DSD ' + struct.pack('<QQQ', 28, metadata_offset + len(tag), metadata_offset))
+        file.write(fmt + data + tag)
+
+
+def generate_corpus(folder, files, args):
+    # Artist/Album layout, album_size tracks per album, every dsf_every
+    # album is DSD
+    paths = []
+    for n in range(files):
+        album, track = divmod(n, args.album_size)
+        album_folder = os.path.join(folder, f'Artist {album // 10:04d}', f'Album {album:05d}')
+        if 0 == track:
+            os.makedirs(album_folder, exist_ok=True)
+        if args.dsf_every and 0 == (album + 1) % args.dsf_every:
+            filename = os.path.join(album_folder, f'{track + 1:02d}.dsf')
+            make_dsf(filename, track + 1, album, args.value_length, args.picture)
+        else:
+            filename = os.path.join(album_folder, f'{track + 1:02d}.flac')
+            user_comments = make_comments(track + 1, album, args.comments,
+                                          args.value_length, args.multi_values)
+            make_flac(filename, user_comments, args.picture, args.padding, args.id3)
+        paths.append(filename)
+    return paths
+
+
+def bytes_read():
+    # rchar counts every byte read through read(2), cached or not
+    try:
+        with open('/proc/self/io') as io_stats:
+            for line in io_stats:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(who).ru_maxrss * 1024
+
+
+def measure(name, paths, fn):
+    before = bytes_read()
+    start = time.perf_counter()
+    for path in paths:
+        fn(path)
+    elapsed = time.perf_counter() - start
+    read = bytes_read() - before
+    return dict(bench=name, files=len(paths),
+                seconds=elapsed,
+                files_per_sec=len(paths) / elapsed if elapsed else 0.0,
+                bytes_per_file=read / len(paths) if paths else 0,
+                peak_rss=peak_rss())
+
+
+def bench_parse(paths):
+
+    def parse(path):
+        if path.endswith('.dsf'):
+            MetaDsf(path).get_id3_tags()
+        else:
+            MetaFlac(path).get_vorbis_comment()
+
+    return measure('parse', paths, parse)
+
+
+def bench_rules(paths):
+    # comments are parsed up front so only rule evaluation is timed
+    rule_set = RuleSet()
+    comments = [MetaFlac(path).get_vorbis_comment()[0]
+                for path in paths if path.endswith('.flac')]
+
+    def evaluate(comment):
+        rule_set.apply({k: list(v) for k, v in comment.items()}, '+8.500000 dB')
+
+    result = measure('rules', comments, evaluate)
+    result['bytes_per_file'] = 0
+    return result
+
+
+def bench_prefetch(paths, latency, threads):
+    # every open pays an artificial round trip, as on a NAS mount, once
+    # serially and once with the concurrent prefetch stage
+    flacs = [path for path in paths if path.endswith('.flac')]
+
+    def opener(filename, mode):
+        time.sleep(latency)
+        return io.open(filename, mode)
+
+    results = []
+    for concurrency in (1, threads):
+        before = bytes_read()
+        start = time.perf_counter()
+        for path, header in prefetch_headers(flacs, 65536, concurrency, opener):
+            MetaFlac(path, fileobj=header).get_vorbis_comment()
+        elapsed = time.perf_counter() - start
+        read = bytes_read() - before
+        results.append(dict(bench=f'prefetch x{concurrency}', files=len(flacs),
+                            seconds=elapsed,
+                            files_per_sec=len(flacs) / elapsed if elapsed else 0.0,
+                            bytes_per_file=read / len(flacs) if flacs else 0,
+                            peak_rss=peak_rss()))
+    return results
+
+
+def bench_main(folder, files, jobs):
+    # a fresh subprocess per run so rchar and peak RSS are the run's own
+    script = ('import runpy, sys\n'
+              f'sys.argv = ["fixflactag.py", "--folder", {folder!r}, "--index", "-", '
+              f'"--journal", "-", "--jobs", "{jobs}"]\n'
+              'try:\n'
+              f'    runpy.run_path({os.path.join(HERE, "fixflactag.py")!r}, run_name="__main__")\n'
+              'except SystemExit:\n'
+              '    pass\n'
+              'for line in open("/proc/self/io"):\n'
+              '    if line.startswith("rchar:"):\n'
+              '        print(line.split()[1])\n')
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-c', script], cwd=HERE,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    read = int(proc.stdout.split()[-1]) if proc.stdout.split() else 0
+    return dict(bench=f'main -j{jobs}', files=files,
+                seconds=elapsed,
+                files_per_sec=files / elapsed if elapsed else 0.0,
+                # parent process only when jobs > 1
+                bytes_per_file=read / files if files else 0,
+                peak_rss=peak_rss(resource.RUSAGE_CHILDREN))
+
+
+def report(results):
+    print(f"{'bench':<12} {'files':>8} {'seconds':>9} {'files/s':>10} "
+          f"{'bytes/file':>11} {'peak RSS MiB':>13}")
+    for result in results:
+        print(f"{result['bench']:<12} {result['files']:>8} {result['seconds']:>9.3f} "
+              f"{result['files_per_sec']:>10.1f} {result['bytes_per_file']:>11.0f} "
+              f"{result['peak_rss'] / (1 << 20):>13.1f}")
+
+
+def main(args):
+    results = []
+    for size in (int(size) for size in args.sizes.split(',')):
+        folder = tempfile.mkdtemp(prefix='fixflactag-bench-', dir=args.workdir)
+        try:
+            paths = generate_corpus(folder, size, args)
+            for bench in args.bench.split(','):
+                if 'parse' == bench:
+                    results.append(bench_parse(paths))
+                elif 'rules' == bench:
+                    results.append(bench_rules(paths))
+                elif 'prefetch' == bench:
+                    results += bench_prefetch(paths, args.latency_ms / 1000.0,
+                                              args.prefetch_threads)
+                elif 'main' == bench:
+                    results.append(bench_main(folder, size, args.jobs))
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    return results
+
+
+parser = argparse.ArgumentParser()
+
+parser.add_argument('--sizes',
+                    help='Comma separated corpus sizes',
+                    type=str,
+                    default='1000')
+parser.add_argument('--bench',
+                    help='Comma separated benchmarks, parse, rules, prefetch and main',
+                    type=str,
+                    default='parse,rules,main')
+parser.add_argument('--comments',
+                    help='Vorbis comments per FLAC',
+                    type=int,
+                    default=20)
+parser.add_argument('--value-length',
+                    help='Filler length of each comment value',
+                    type=int,
+                    default=16)
+parser.add_argument('--multi-values',
+                    help='Extra ; joined ARTIST values',
+                    type=int,
+                    default=0)
+parser.add_argument('--picture',
+                    help='Embedded picture size in bytes',
+                    type=int,
+                    default=0)
+parser.add_argument('--padding',
+                    help='PADDING block size in bytes',
+                    type=int,
+                    default=8192)
+parser.add_argument('--id3',
+                    help='Prefix every FLAC with an ID3 tag',
+                    action='store_true')
+parser.add_argument('--album-size',
+                    help='Tracks per album',
+                    type=int,
+                    default=12)
+parser.add_argument('--dsf-every',
+                    help='Make every Nth album DSF, 0 for none',
+                    type=int,
+                    default=10)
+parser.add_argument('--jobs', '-j',
+                    help='Worker processes for the main benchmark',
+                    type=int,
+                    default=1)
+parser.add_argument('--latency-ms',
+                    help='Artificial latency per open for the prefetch benchmark',
+                    type=float,
+                    default=5.0)
+parser.add_argument('--prefetch-threads',
+                    help='Concurrency for the prefetch benchmark',
+                    type=int,
+                    default=16)
+parser.add_argument('--workdir',
+                    help='Where the corpus is generated',
+                    type=str,
+                    default=None)
+parser.add_argument('--json',
+                    help='Also write the results to this file',
+                    type=str,
+                    default=None)
+
+if __name__ == "__main__":
+    main(parser.parse_args())
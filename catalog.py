@@ -0,0 +1,136 @@
+import os
+import csv
+import array
+import logging
+from metaflac import MetaFlac
+from metadsf import MetaDsf
+
+logger = logging.getLogger('fixflactag.catalog')
+
+# library catalog of stream properties, header reads only
+# rows are held column by column in typed arrays, written as CSV and
+# as Parquet when pyarrow is installed, else NumPy .npz when numpy is
+# both are imported when a catalog is written, not with the module, so
+# runs that never catalogue do not pay for them
+
+numpy = pyarrow = None
+_loaded = False
+
+
+def _load():
+    global numpy, pyarrow, _loaded
+    if _loaded:
+        return
+    _loaded = True
+    try:
+        import numpy
+    except ImportError:
+        pass
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        pass
+
+
+# column name, array typecode, None for strings
+COLUMNS = (('path', None),
+           ('format', None),
+           ('sample_rate', 'l'),
+           ('bits_per_sample', 'l'),
+           ('channels', 'l'),
+           ('total_samples', 'q'),
+           ('seconds', 'd'),
+           ('md5', None),
+           ('seekpoints', 'l'),
+           ('seekpoint_placeholders', 'l'),
+           ('audio_offset', 'q'),
+           ('file_size', 'q'))
+
+SEEKPOINT_PLACEHOLDER = 0xffffffffffffffff
+
+
+def catalog_entry(filename, fileobj=None):
+    row = dict(path=filename, md5='', seekpoints=0, seekpoint_placeholders=0)
+    if filename.lower().endswith('.dsf'):
+        meta = MetaDsf(filename)
+        row['format'] = 'dsf'
+        streaminfo = meta.get_streaminfo()
+    else:
+        meta = MetaFlac(filename, fileobj=fileobj)
+        row['format'] = 'flac'
+        streaminfo = meta.get_streaminfo() or dict()
+        if streaminfo.get('md5'):
+            row['md5'] = streaminfo['md5'].hex()
+        seektable = meta.get_seektable() or []
+        row['seekpoints'] = len(seektable)
+        row['seekpoint_placeholders'] = sum(1 for number, _, _ in seektable
+                                            if SEEKPOINT_PLACEHOLDER == number)
+    row['sample_rate'] = streaminfo.get('sample_rate', 0)
+    row['bits_per_sample'] = streaminfo.get('bits_per_sample', 0)
+    row['channels'] = streaminfo.get('number_of_channels', 0)
+    row['total_samples'] = streaminfo.get('total_samples_in_stream', 0)
+    row['seconds'] = row['total_samples'] / row['sample_rate'] if row['sample_rate'] else 0.0
+    row['audio_offset'] = meta.get_audio_offset()
+    row['file_size'] = os.path.getsize(filename)
+    return row
+
+
+class Catalog:
+
+    def __init__(self):
+        self.columns = {name: [] if typecode is None else array.array(typecode)
+                        for name, typecode in COLUMNS}
+
+    def __len__(self):
+        return len(self.columns['path'])
+
+    def append(self, row):
+        for name, column in self.columns.items():
+            column.append(row[name])
+
+    def write_csv(self, filename):
+        with open(filename, 'w', newline='') as out:
+            writer = csv.writer(out)
+            writer.writerow(self.columns)
+            writer.writerows(zip(*self.columns.values()))
+
+    def write_parquet(self, filename):
+        _load()
+        table = pyarrow.table({name: pyarrow.array(column)
+                               for name, column in self.columns.items()})
+        pyarrow.parquet.write_table(table, filename)
+
+    def write_npz(self, filename):
+        _load()
+        numpy.savez_compressed(filename, **{name: numpy.asarray(column)
+                                            for name, column in self.columns.items()})
+
+    def write(self, basename):
+        # basename.csv always, plus the best columnar format available
+        written = [basename + '.csv']
+        self.write_csv(written[0])
+        _load()
+        if pyarrow is not None:
+            written.append(basename + '.parquet')
+            self.write_parquet(written[-1])
+        elif numpy is not None:
+            written.append(basename + '.npz')
+            self.write_npz(written[-1])
+        else:
+            logger.info('Install pyarrow or numpy for a columnar catalog')
+        return written
+
+    def summary(self):
+        # totals by format, sample rate and bit depth for capacity planning
+        totals = dict()
+        for fmt, rate, bits, seconds, size in zip(self.columns['format'],
+                                                  self.columns['sample_rate'],
+                                                  self.columns['bits_per_sample'],
+                                                  self.columns['seconds'],
+                                                  self.columns['file_size']):
+            entry = totals.setdefault((fmt, rate, bits), [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] += size
+        return totals
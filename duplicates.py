@@ -0,0 +1,120 @@
+import re
+import json
+import unicodedata
+from tagmodel import handler_for
+
+# duplicate rips from headers alone, no audio is decoded
+# exact  - the same STREAMINFO MD5 of the decoded audio (FLAC only, an
+#          all zero MD5 means the encoder did not set one)
+# near   - the same normalized ARTIST, ALBUM and TITLE and durations
+#          no more than DURATION_BUCKET seconds apart, e.g. a CD rip and
+#          a vinyl rip of a track
+# a near group whose files are all one exact group is not repeated
+
+DURATION_BUCKET = 2.0  # seconds
+UNSET_MD5 = '0' * 32
+
+BRACKETED = re.compile(r'\([^)]*\)|\[[^\]]*\]|\{[^}]*\}')
+PUNCTUATION = re.compile(r'[^\w\s]')
+SPACES = re.compile(r'\s+')
+
+
+def normalize(value):
+    # case, accents, bracketed extras ([24bVR], (Remastered)), punctuation
+    # and a leading 'the' do not tell two rips of a track apart
+    value = unicodedata.normalize('NFKD', value or '')
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    value = BRACKETED.sub(' ', value.casefold())
+    value = SPACES.sub(' ', PUNCTUATION.sub(' ', value)).strip()
+    if value.startswith('the '):
+        value = value[4:]
+    return value
+
+
+def _first(comment, key):
+    values = comment.get(key)
+    return values[0] if values else ''
+
+
+def duplicate_entry(filename):
+    # (md5, (artist, album, title), seconds)
+    handler = handler_for(filename)
+    comment = handler.read()[0]
+    streaminfo = handler.meta.get_streaminfo() or dict()
+    md5 = streaminfo.get('md5', b'')
+    md5 = md5.hex() if isinstance(md5, bytes) else ''
+    rate = streaminfo.get('sample_rate', 0)
+    seconds = streaminfo.get('total_samples_in_stream', 0) / rate if rate else 0.0
+    key = tuple(normalize(_first(comment, tag)) for tag in ('ARTIST', 'ALBUM', 'TITLE'))
+    return md5 if md5 != UNSET_MD5 else '', key, seconds
+
+
+class DuplicateIndex:
+
+    def __init__(self, bucket=DURATION_BUCKET):
+        self.bucket = bucket
+        self.paths = []
+        self.seconds = []
+        # md5 -> [path index], (artist, album, title) -> [path index]
+        self.by_md5 = dict()
+        self.by_key = dict()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def add(self, path, entry):
+        md5, key, seconds = entry
+        idx = len(self.paths)
+        self.paths.append(path)
+        self.seconds.append(seconds)
+        if md5:
+            self.by_md5.setdefault(md5, []).append(idx)
+        if key[0] and key[2]:
+            # untagged files would all look alike
+            self.by_key.setdefault(key, []).append(idx)
+
+    def exact(self):
+        # [(md5, [path, ...])]
+        return [(md5, [self.paths[idx] for idx in members])
+                for md5, members in self.by_md5.items() if len(members) > 1]
+
+    def near(self):
+        # [((artist, album, title), [path, ...])], tracks of one key sorted
+        # by duration and split wherever neighbours are more than a bucket
+        # apart, so no boundary separates two rips of the same length
+        md5_of = dict()
+        for md5, members in self.by_md5.items():
+            for idx in members:
+                md5_of[idx] = md5
+        near = []
+        for key, members in self.by_key.items():
+            if len(members) < 2:
+                continue
+            members = sorted(members, key=self.seconds.__getitem__)
+            cluster = members[:1]
+            for idx in members[1:] + [None]:
+                if idx is not None and \
+                   self.seconds[idx] - self.seconds[cluster[-1]] <= self.bucket:
+                    cluster.append(idx)
+                    continue
+                # a cluster that is one exact group is reported as such
+                if len({md5_of.get(member, member) for member in cluster}) > 1:
+                    near.append((key, [self.paths[member] for member in cluster]))
+                cluster = [idx]
+        return near
+
+    def write(self, filename):
+        # JSON lines, one group each, '-' for stdout
+        exact, near = self.exact(), self.near()
+        lines = [json.dumps(dict(match='exact', md5=md5, paths=paths))
+                 for md5, paths in exact]
+        lines += [json.dumps(dict(match='near', artist=key[0], album=key[1],
+                                  title=key[2], paths=paths))
+                  for key, paths in near]
+        text = ''.join(line + '\n' for line in lines)
+        if '-' == filename:
+            print(text, end='')
+        else:
+            with open(filename, 'w') as out:
+                out.write(text)
+        return len(exact), len(near)
@@ -0,0 +1,119 @@
+import logging
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('fixflactag.executor')
+
+# external tag tools (metaflac, id3v2, metadsf) run from argv lists, no
+# shell and no quoting, with the files that get the same edit sharing an
+# invocation
+# an edit is the tool with its fixed options (the prefix), the option
+# groups for the file (units, one per tag) and the file; the units every
+# file of a prefix shares go in one call for all of them, what is left
+# is grouped again by identical units
+# prefixes run by stage, then in the order they were first added, so an
+# id3v2 strip (stage 0) is done before any metaflac edit (stage 1); the
+# calls of one step touch different files so they run concurrently,
+# jobs at a time
+
+MAX_FILES = 256  # per call, well inside ARG_MAX
+
+# options whose comma separated values are merged into one option
+MERGED_OPTIONS = ('--remove-tags=',)
+
+
+def _merge_options(units):
+    argv = []
+    merged = dict()
+    for unit in units:
+        for option in unit:
+            prefix = next((p for p in MERGED_OPTIONS if option.startswith(p)), None)
+            if prefix is None:
+                argv.append(option)
+            elif prefix in merged:
+                argv[merged[prefix]] += ',' + option[len(prefix):]
+            else:
+                merged[prefix] = len(argv)
+                argv.append(option)
+    return argv
+
+
+class ToolBatch:
+
+    def __init__(self, jobs=4, timer=None):
+        self.jobs = jobs
+        self.__timer = timer or (lambda stage: contextlib.nullcontext())
+        # (stage, prefix) -> [(units, filename)] in the order added
+        self.__edits = dict()
+
+    def __len__(self):
+        return sum(len(edits) for edits in self.__edits.values())
+
+    def add(self, prefix, units, filename, stage=0):
+        self.__edits.setdefault((stage, tuple(prefix)), []).append((tuple(units), filename))
+
+    def __calls(self, prefix, units, filenames):
+        # [(argv without files, files)]
+        head = list(prefix) + _merge_options(units)
+        return [(head, filenames[idx:idx + MAX_FILES])
+                for idx in range(0, len(filenames), MAX_FILES)]
+
+    def steps(self):
+        # [(prefix, [(head, files), ...]), ...], the calls of a step are
+        # independent of each other
+        steps = []
+        for (_, prefix), edits in sorted(self.__edits.items(), key=lambda item: item[0][0]):
+            shared = set(edits[0][0])
+            for units, _ in edits[1:]:
+                shared &= set(units)
+            if len(edits) > 1 and shared:
+                ordered = [unit for unit in edits[0][0] if unit in shared]
+                steps.append((prefix, self.__calls(prefix, ordered,
+                                                   [filename for _, filename in edits])))
+            else:
+                shared = set()
+            rest = dict()
+            for units, filename in edits:
+                remaining = tuple(unit for unit in units if unit not in shared)
+                # a file with no units at all still needs its call
+                if remaining or not units:
+                    rest.setdefault(remaining, []).append(filename)
+            calls = []
+            for units, filenames in rest.items():
+                calls += self.__calls(prefix, units, filenames)
+            if calls:
+                steps.append((prefix, calls))
+        return steps
+
+    def __call(self, argv):
+        logger.debug(' '.join(argv))
+        try:
+            with self.__timer(f'exec_{argv[0]}'):
+                proc = subprocess.run(argv, stdout=subprocess.DEVNULL,
+                                      stderr=subprocess.PIPE)
+        except OSError as err:
+            logger.warning(f'{argv[0]}: {err}')
+            return False
+        if proc.returncode:
+            logger.warning(f'{argv[0]} exit {proc.returncode}: '
+                           f'{proc.stderr.decode(errors="replace").strip()}')
+            return False
+        return True
+
+    def run(self):
+        # runs and clears the batch, returns the files a call failed on,
+        # a file whose earlier step failed is left out of the later ones
+        failed = set()
+        steps = self.steps()
+        self.__edits = dict()
+        with ThreadPoolExecutor(self.jobs) as pool:
+            for _, calls in steps:
+                calls = [(head, [filename for filename in files if filename not in failed])
+                         for head, files in calls]
+                calls = [(head, files) for head, files in calls if files]
+                argvs = [head + files for head, files in calls]
+                for (_, files), ok in zip(calls, pool.map(self.__call, argvs)):
+                    if not ok:
+                        failed.update(files)
+        return failed
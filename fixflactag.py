@@ -1,17 +1,92 @@
 #/usr/bin/python3
 
+import io
 import os
 import sys
+import json
 import argparse
 import logging
-import subprocess
-import glob
+import signal
+import time
 import datetime
-from pathlib import Path
-from metaflac import MetaFlac
-from metadsf import MetaDsf
+from tagmodel import FlacHandler, DsfHandler, handler_for
+from scanindex import ScanIndex, tag_digest, stat_key
+from walker import walk_library
+from rules import RuleSet
+from prefetch import prefetch_headers
+from album import album_context, is_compilation
+from watcher import LibraryWatcher
+from catalog import Catalog, catalog_entry
+from duplicates import DuplicateIndex, duplicate_entry
+from tagstore import TagStore, tag_pairs
+from artwork import dedupe_album_artwork
+from journal import Journal
+from safewrite import remove_stale_temps
+from executor import ToolBatch
+from verify import meta_audio_digest, file_audio_digest, verify_files
+import loudness
+from stats import Stats, bytes_read, write_json, write_prometheus
 import re
 import contextlib
+import itertools
+import functools
+from collections import Counter, deque
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+
+
+logger = logging.getLogger('fixflactag')
+
+# bump whenever the fixes below change so indexed files are rechecked
+RULES_VERSION = 5
+
+# compiled once, shared by every file a process handles
+FLAC_RULES = RuleSet()
+
+# stage timings and counters, per process like the rule stats
+STATS = Stats()
+
+
+@dataclass
+class Options:
+
+    # everything a run is told, the command line options by another
+    # name, fix_paths callers set only what they need
+    folder: str = None
+    various: int = 0
+    backup: int = 0
+    discnumber: int = 1
+    disctotal: int = 1
+    swap: int = 0
+    tracktotal: int = 0
+    writer: str = 'native'
+    padding: int = 8192
+    tool_jobs: int = 4
+    verify: bool = False
+    verify_samples: int = 0
+    loudness: bool = False
+    jobs: int = 1
+    depth: int = 3
+    albums: bool = False
+    prefetch: int = 0
+    prefetch_threads: int = 16
+    index: str = None
+    full: bool = False
+    journal: str = None
+    atomic: bool = False
+    plan: str = None
+    apply: str = None
+    catalog: str = None
+    duplicates: str = None
+    find: str = None
+    artwork: bool = False
+    thumbnail: int = 0
+    max_padding: int = 65536
+    watch: bool = False
+    settle: float = 5.0
+    rule_stats: bool = False
+    stats: str = None
+    prometheus: str = None
 
 
 @contextlib.contextmanager
@@ -22,186 +97,81 @@ def ignored(*exceptions):
         pass
 
 
-def run_command(cmd, exc=0):
+def tag_changes(before, after, recased=()):
 
-    logging.debug(cmd)
-    if 1 == exc:
-        try:
-            rc = subprocess.run(cmd, shell=True)
-            if 0 == rc.returncode:
-                return True
-        except subprocess.CalledProcessError as err:
-            logger.warning(err.output)
-            return False
-    return False
-
-
-def fix_dsf_tags(filename,
-                 isvarious=0,
-                 replay_gain='+8.500000 dB',
-                 discnumber=-1,
-                 disctotal=-1,
-                 tracktotal=-1,
-                 swaptags=0):
+    # the review view of a plan, tags added, removed and rewritten
+    # recased keys are rewritten to normalise their case
+    add = {k: v for k, v in after.items() if not before.get(k)}
+    remove = sorted(k for k in before if before[k] and k not in after)
+    rewrite = {k: v for k, v in after.items()
+               if before.get(k) and (before[k] != v or k in recased)}
+    return dict(add=add, remove=remove, rewrite=rewrite)
 
-    changed = False
-    remove_tags = []
-    add_tags = None
 
-    metadsf = MetaDsf(filename)
-    dsf_tags = metadsf.get_id3_tags()
+def comment_pairs(flac_comment):
 
-    if 'TENC' in dsf_tags and 'VinylStudio' == dsf_tags['TENC']:
-        dsf_tags.pop('TENC', None)
-        remove_tags.append('TENC')
-        logging.debug('Delete TENC Tag')
-        changed = True
+    # flatten to sorted KEY=value pairs, dropping placeholder values
+    user_comments = []
+    for k, v in sorted(flac_comment.items()):
+        for vv in v:
+            if "\n" in vv:
+                vv = vv.replace('\r\n', ' ')
+                vv = vv.replace('\n', ' ')
+                vv = vv.replace('\r', ' ')
+            if vv!='None' and vv!='Not On Label':
+                if vv:
+                    user_comments.append((k, vv))
+    return user_comments
 
-    if 'TIT1' in dsf_tags and \
-       'COMM' in dsf_tags and \
-       dsf_tags['TIT1'] == dsf_tags['COMM']:
-        dsf_tags.pop('TIT1', None)
-        remove_tags.append('TIT1')
-        logging.debug('Delete TIT1 Tag')
-        changed = True
 
-    if 'TORY' not in dsf_tags and \
-       'TDRC' in dsf_tags:
-        dsf_tags['TORY'] = dsf_tags['TDRC']
-        add_tags = f"--add-tag=TORY={dsf_tags['TDRC']}"
-        logging.debug('Add TORY Tag')
-        changed = True
-
-    if changed:
-        logging.debug(f'Rewrite DSF tags on "{filename}"')
-        # metadsf command line - heavily buttoned down
-        cmd = 'metadsf --encoding=UTF8'
-        if 0 != len(remove_tags):
-            cmd += ' --remove-tags={}'.format(','.join(remove_tags))
-        if add_tags:
-            cmd += f' {add_tags}'
-        cmd += f' "{filename}"'
-        run_command(cmd, 1)
-
-
-def fix_flac_tags(filename,
-                  isvarious=0,
-                  replay_gain='+8.500000 dB',
-                  discnumber=0,
-                  disctotal=0,
-                  tracktotal=0,
-                  swaptags=0):
+def plan_tags(handler,
+              isvarious=0,
+              replay_gain='+8.500000 dB',
+              discnumber=0,
+              disctotal=0,
+              tracktotal=0,
+              swaptags=0,
+              album=None,
+              gains=None):
 
+    # the fixes run on the common tag model whatever the format, see
+    # tagmodel for the handlers
+    # gains are measured ReplayGain tags, added where missing
     changed = False
-    vinyl_rip = '24bVR'
     today = datetime.date.today()
 
-    metaflac = MetaFlac(filename)
-    flac_comment, changed, ID3_tags = metaflac.get_vorbis_comment()
+    flac_comment, changed, ID3_tags = handler.read()
 
     if ID3_tags:
         changed = True
 
-    tags_file = '%d.tag' % (os.getpid())
-    tf = Path(tags_file)
-
-    if tf.exists():
-        tf.unlink()
-
-    if 0 == isvarious:
-        with ignored(KeyError, IndexError):
-            # ensure boolean attrs supported
-            isvarious = int(flac_comment['COMPILATION'][0] in ('1','True','Y'))
-            if 0 == isvarious:
-                with ignored(KeyError, IndexError):
-                    isvarious = int(0 != flac_comment['ALBUMARTIST'][0].lower().find("various"))
-                    if 0 == isvarious:
-                        with ignored(KeyError, IndexError):
-                            isvarious = int(0 != flac_comment['ALBUM ARTIST'][0].lower().find("various"))
-
-    # add the replaygain bump for vinyl rips
-    if 'CONTACT' in flac_comment and \
-       'VinylStudio' == flac_comment['CONTACT'][0]:
-        if 'REPLAYGAIN_TRACK_GAIN' not in flac_comment:
-            flac_comment['REPLAYGAIN_TRACK_GAIN'].append(replay_gain)
-            logging.debug('Adding REPLAYGAIN_TRACK_GAIN Tag')
-            changed = True
+    if handler.fixes(flac_comment):
+        changed = True
 
-    with ignored(KeyError, IndexError):
-        if 'ffz' in flac_comment['COMMENTS'][0] or 'FFZ' in flac_comment['COMMENTS'][0] or '' == flac_comment['COMMENTS'][0].strip():
-            logging.debug('Default COMMENT Tag')
-            flac_comment.pop('COMMENTS', None)
-            changed = True
-    with ignored(KeyError, IndexError):
-        if 'fzz' in flac_comment['COMMENTS'][0] or 'FZZ' in flac_comment['COMMENTS'][0] or '' == flac_comment['COMMENTS'][0].strip():
-            logging.debug('Default COMMENT Tag')
-            flac_comment.pop('COMMENTS', None)
-            changed = True
+    albumartist = None
+    if album:
+        # decided once for the whole album folder
+        isvarious = isvarious or album.various
+        albumartist = album.albumartist
+        discnumber = album.discnumber or discnumber
+        disctotal = album.disctotal or disctotal
+        tracktotal = album.tracktotal or tracktotal
 
-    with ignored(KeyError, IndexError):
-        if 'ffz' in flac_comment['COMMENT'][0] or 'FFZ' in flac_comment['COMMENT'][0] or '' == flac_comment['COMMENT'][0].strip():
-            logging.debug('Default COMMENT Tag')
-            flac_comment.pop('COMMENT', None)
-            changed = True
-    with ignored(KeyError, IndexError):
-        if 'fzz' in flac_comment['COMMENT'][0] or 'FZZ' in flac_comment['COMMENT'][0] or '' == flac_comment['COMMENT'][0].strip():
-            logging.debug('Default COMMENT Tag')
-            flac_comment.pop('COMMENT', None)
-            changed = True
+    elif 0 == isvarious:
+        isvarious = int(is_compilation(flac_comment))
 
-    with ignored(KeyError, IndexError):
-        if 'inyl' in flac_comment['COMMENTS'][0] or \
-        'Digitally' in flac_comment['COMMENTS'][0] or \
-        'inyl' in flac_comment['COMMENT'][0] or \
-        'Digitally' in flac_comment['COMMENT'][0]:
-            if 'REPLAYGAIN_TRACK_GAIN' not in flac_comment:
-                flac_comment['REPLAYGAIN_TRACK_GAIN'].append(replay_gain)
-                logging.debug('Add REPLAYGAIN_TRACK_GAIN Tag')
-                changed = True
-            flac_comment.pop('COMMENTS', None)
+    # a measured gain leaves the fixed vinyl bump below nothing to do
+    for key, value in (gains or dict()).items():
+        if key not in flac_comment:
+            flac_comment[key] = [value]
+            logger.debug(f'Add {key} Tag')
             changed = True
 
-    with ignored(KeyError, IndexError):
-        if 'ffz' in flac_comment['COMMENTS'][0] or 'FFZ' in flac_comment['COMMENTS'][0]:
-            logging.debug('Default COMMENT Tag')
-            flac_comment.pop('COMMENTS', None)
-            changed = True
-        if 'fzz' in flac_comment['COMMENT'][0] or 'FZZ' in flac_comment['COMMENT'][0]:
-            logging.debug('Default COMMENT Tag')
-            flac_comment.pop('COMMENT', None)
-            changed = True
-        if 'NAD' in flac_comment['COMMENTS'][0]:
-            if 'REPLAYGAIN_TRACK_GAIN' not in flac_comment:
-                flac_comment['REPLAYGAIN_TRACK_GAIN'].append(replay_gain)
-                logging.debug('Add REPLAYGAIN_TRACK_GAIN Tag')
-                flac_comment.pop('COMMENTS', None)
-                changed = True
-        if 'NAD' in flac_comment['COMMENT'][0]:
-            if 'REPLAYGAIN_TRACK_GAIN' not in flac_comment:
-                flac_comment['REPLAYGAIN_TRACK_GAIN'].append(replay_gain)
-                logging.debug('Add REPLAYGAIN_TRACK_GAIN Tag')
-                changed = True
-        if vinyl_rip in flac_comment['ALBUM'][0]:
-            if 'REPLAYGAIN_TRACK_GAIN' not in flac_comment:
-                flac_comment['REPLAYGAIN_TRACK_GAIN'].append(replay_gain)
-                logging.debug('Add REPLAYGAIN_TRACK_GAIN Tag')
-                changed = True
-        if 'inyl' in flac_comment['COMMENT'][0] or 'Digitally' in flac_comment['COMMENT'][0]:
-            if 'REPLAYGAIN_TRACK_GAIN' not in flac_comment:
-                flac_comment['REPLAYGAIN_TRACK_GAIN'].append(replay_gain)
-                logging.debug('Add REPLAYGAIN_TRACK_GAIN Tag')
-                changed = True
-            flac_comment.pop('COMMENT', None)
-            changed = True
-        if 'inyl' in flac_comment['COMMENTS'][0] or 'Digitally' in flac_comment['COMMENTS'][0]:
-            if 'REPLAYGAIN_TRACK_GAIN' not in flac_comment:
-                flac_comment['REPLAYGAIN_TRACK_GAIN'].append(replay_gain)
-                logging.debug('Add REPLAYGAIN_TRACK_GAIN Tag')
-                changed = True
-            flac_comment.pop('COMMENTS', None)
-            changed = True
+    # comment cleanup and the replaygain bump for vinyl rips
+    if FLAC_RULES.apply(flac_comment, replay_gain):
+        changed = True
 
-    if 'CATALOGNUMBER' not in flac_comment:
+    if 'CATALOGNUMBER' not in flac_comment and flac_comment.get('ALBUM'):
         if '[' in flac_comment['ALBUM'][0]:
             regex = r'\[([^\[]*)\][^\[]*$'
             unpack = re.split(regex,
@@ -209,11 +179,11 @@ def fix_flac_tags(filename,
                               maxsplit=1)
             if unpack:
                 flac_comment['CATALOGNUMBER'].append(unpack[1].strip())
-                logging.debug('Adding CATALOGNUMBER Tag')
+                logger.debug('Adding CATALOGNUMBER Tag')
                 changed = True
 
     # dump redundant tags
-    red_tags = ('CONTACT', 'LOCATION', 'GROUPING')
+    red_tags = ()
     if 1 == isvarious:
         red_tags += ('ALBUMARTIST', 'ALBUM ARTIST')
         if 'COMPILATION' not in flac_comment:
@@ -222,7 +192,7 @@ def fix_flac_tags(filename,
     for redundant in red_tags:
         if redundant in flac_comment:
             flac_comment.pop(redundant, None)
-            logging.debug(f'Delete {redundant} Tag')
+            logger.debug(f'Delete {redundant} Tag')
             changed = True
 
     if swaptags:
@@ -235,10 +205,18 @@ def fix_flac_tags(filename,
     for idx, artist in enumerate(flac_comment['ARTIST']):
         if 'none'==artist.lower():
             flac_comment['ARTIST'].pop(idx)
-            logging.debug('Cleanup ARTIST Tag')
+            logger.debug('Cleanup ARTIST Tag')
             changed = True
 
 
+    # one album artist across the album
+    if 0 == isvarious and albumartist and \
+       flac_comment.get('ALBUMARTIST') != [albumartist]:
+        flac_comment.pop('ALBUM ARTIST', None)
+        flac_comment['ALBUMARTIST'] = [albumartist]
+        logger.debug('Align ALBUMARTIST Tag')
+        changed = True
+
     # patch for missing album artist
     # isvarious we should really delete the album artist tag if exists
     if 0 == isvarious and \
@@ -247,37 +225,32 @@ def fix_flac_tags(filename,
         for artist in flac_comment['ARTIST']:
             if 'none'!=artist.lower():
                 flac_comment['ALBUMARTIST'].append(artist)
-                logging.debug('Adding ALBUMARTIST Tag')
+                logger.debug('Adding ALBUMARTIST Tag')
                 changed = True
 
     if 'DATE' in flac_comment:
         if len(flac_comment['DATE']) > 1:
             flac_comment['DATE'] = flac_comment['DATE'][:1]
-            logging.debug('Cleanup DATE Tag')
+            logger.debug('Cleanup DATE Tag')
             changed = True
 
     # add signature if not present
     if 'COMMENT' not in flac_comment:
         flac_comment['COMMENT'].append(f'FixFlac {today}')
-        logging.debug('Adding COMMENT Tag')
+        logger.debug('Adding COMMENT Tag')
         changed = True
     else:
         # address multi-line comments
         if "\n" in flac_comment['COMMENT']:
-            logging.debug('Fix multi-line COMMENT Tag')
+            logger.debug('Fix multi-line COMMENT Tag')
             flac_comment.pop('COMMENT', None)
             changed = True
 
     if 'COMMENT' not in flac_comment:
         flac_comment['COMMENT'].append(f'FixFlac {today}')
-        logging.debug('Adding COMMENT Tag')
+        logger.debug('Adding COMMENT Tag')
         changed = True
 
-    for test_tag in ('MEDIA','DESCRIPTION','URL_DISCOGS_RELEASE_SITE'):
-        if test_tag in flac_comment:
-            flac_comment.pop(test_tag, None)
-            changed = True
-
     # fix disktotal, disknumber tag typo
 
     for test_tag in ('DISKNUMBER', 'DISKTOTAL'):
@@ -288,8 +261,8 @@ def fix_flac_tags(filename,
                 with ignored(KeyError, ValueError):
                     value = str(int(flac_comment[test_tag][0])).zfill(2)
                 flac_comment[new_tag].append(value)
-                logging.debug(f'Adding {new_tag} Tag')
-            logging.debug(f'Cleanup {test_tag} Tag')
+                logger.debug(f'Adding {new_tag} Tag')
+            logger.debug(f'Cleanup {test_tag} Tag')
             flac_comment.pop(test_tag, None)
             changed = True
 
@@ -304,96 +277,990 @@ def fix_flac_tags(filename,
                     value = tracktotal
                 if value > 0:
                     flac_comment[test_tag].append(str(value).zfill(2))
-                    logging.debug(f'Adding {test_tag} Tag')
+                    logger.debug(f'Adding {test_tag} Tag')
                     changed = True
 
-    if changed:
-        logging.debug(f'Rewrite FLAC tags on "{filename}"')
-        text = ''
-        for k, v in sorted(flac_comment.items()):
-            for vv in v:
-                if "\n" in vv:
-                    vv = vv.replace('\r\n', ' ')
-                    vv = vv.replace('\n', ' ')
-                    vv = vv.replace('\r', ' ')
-                if vv!='None' and vv!='Not On Label':
-                    if vv:
-                        text += f"{k}={vv}\n"
-        tf.write_text(text)
-
-        if tf.exists():
-
-            if ID3_tags:
-                cmd = f'id3v2 --delete-all "{filename}"'
-                run_command(cmd, 1)
-
-            # metaflac command line
-            cmd = 'metaflac --preserve-modtime --no-utf8-convert'
-            cmd += ' --remove-all-tags'
-            if '"' in filename:
-                cmd += f" --import-tags-from={tags_file} '{filename}'"
+    if not changed:
+        return None
+
+    user_comments = comment_pairs(flac_comment)
+    after = dict()
+    for k, v in user_comments:
+        after.setdefault(k, []).append(v)
+    plan = dict(path=handler.filename, format=handler.format, id3=ID3_tags,
+                tags=user_comments)
+    # against the file as stored, ';' splits and key case included, so
+    # the external writers redo those too
+    before, recased = handler.stored()
+    plan.update(tag_changes(before, after, recased))
+    return plan
+
+
+def write_external_flac(plan, batch):
+
+    # metaflac edits only the tags that change, a tag's remove and set
+    # options go together so albums share the calls for common edits
+    filename = plan['path']
+    if plan['id3']:
+        batch.add(('id3v2', '--delete-all'), (), filename)
+
+    units = [(f'--remove-tag={k}',) for k in plan['remove']]
+    for k, values in sorted(plan['rewrite'].items()):
+        units.append((f'--remove-tag={k}',) + tuple(f'--set-tag={k}={v}' for v in values))
+    for k, values in sorted(plan['add'].items()):
+        units.append(tuple(f'--set-tag={k}={v}' for v in values))
+    if units:
+        batch.add(('metaflac', '--preserve-modtime', '--no-utf8-convert'), units, filename,
+                  stage=1)
+
+
+def write_external_dsf(plan, handler, batch):
+
+    # metadsf works on frames, rewritten frames are removed and added
+    filename = plan['path']
+    changes = tag_changes(handler.meta.get_id3_tags(), handler.frames(plan['tags']))
+    units = [(f'--remove-tags={k}',) for k in changes['remove']]
+    for k, v in sorted(changes['rewrite'].items()):
+        units.append((f'--remove-tags={k}', f'--add-tag={k}={v}'))
+    for k, v in sorted(changes['add'].items()):
+        units.append((f'--add-tag={k}={v}',))
+    if units:
+        batch.add(('metadsf', '--encoding=UTF8'), units, filename)
+
+
+def run_batch(batch):
+
+    # the external tools, returns the files they failed on
+    with STATS.timer('write'):
+        failed = batch.run()
+    STATS.count('exec_errors', len(failed))
+    return failed
+
+
+def write_tags(plan, writer='native', padding=8192, handler=None, atomic=False,
+               batch=None):
+
+    # external writes go to batch when given, its owner runs it
+    filename = plan['path']
+    logger.debug(f'Rewrite {plan["format"].upper()} tags on "{filename}"')
+    if handler is None:
+        handler = handler_for(filename)
+
+    if 'native' == writer:
+        with STATS.timer('write'):
+            handler.write(plan['tags'], padding=padding,
+                          strip_id3=plan['id3'], atomic=atomic)
+        return
+
+    run_now = batch is None
+    if run_now:
+        batch = ToolBatch(timer=STATS.timer)
+    if 'dsf' == handler.format:
+        write_external_dsf(plan, handler, batch)
+    else:
+        write_external_flac(plan, batch)
+    if run_now and run_batch(batch):
+        raise RuntimeError(f'External tools failed on "{filename}"')
+
+
+def fix_tags(handler,
+             isvarious=0,
+             replay_gain='+8.500000 dB',
+             discnumber=0,
+             disctotal=0,
+             tracktotal=0,
+             swaptags=0,
+             writer='native',
+             padding=8192,
+             album=None,
+             atomic=False,
+             batch=None,
+             gains=None):
+
+    with STATS.timer('rules'):
+        plan = plan_tags(handler,
+                         isvarious=isvarious,
+                         replay_gain=replay_gain,
+                         discnumber=discnumber,
+                         disctotal=disctotal,
+                         tracktotal=tracktotal,
+                         swaptags=swaptags,
+                         album=album,
+                         gains=gains)
+    if plan:
+        write_tags(plan, writer, padding, handler, atomic, batch)
+    return bool(plan)
+
+
+def fix_flac_tags(filename, fileobj=None, metaflac=None, **kwargs):
+    return fix_tags(FlacHandler(filename, meta=metaflac, fileobj=fileobj), **kwargs)
+
+
+def fix_dsf_tags(filename, metadsf=None, **kwargs):
+    return fix_tags(DsfHandler(filename, meta=metadsf), **kwargs)
+
+
+class LogBuffer(logging.Handler):
+
+    # holds a worker's log records so the parent can replay them in order
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+
+    def emit(self, record):
+        # flatten to something that pickles
+        record.msg = self.format(record) if record.exc_info else record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+log_buffer = None
+
+
+def init_worker():
+    global log_buffer
+    # Ctrl-C is for the parent, it shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log_buffer = LogBuffer()
+    logging.getLogger('').handlers = [log_buffer]
+    logging.getLogger('').setLevel(logging.DEBUG)
+
+
+def rules_key(args):
+    # the options that change the outcome are part of the rules too
+    return (f'{RULES_VERSION}:{args.various}:{args.discnumber}:'
+            f'{args.disctotal}:{args.tracktotal}:{args.swap}:{int(args.albums)}:'
+            f'{int(args.loudness)}')
+
+
+def fix_options(args):
+    return dict(isvarious=args.various,
+                discnumber=args.discnumber,
+                disctotal=args.disctotal,
+                tracktotal=args.tracktotal,
+                swaptags=args.swap)
+
+
+def check_audio(results, args):
+
+    # results written with --verify, a file whose audio digest differs
+    # from the one taken before the write is failed
+    expected = {result['filename']: result['audio'] for result in results
+                if result.get('audio') and result['changed'] and not result['error']}
+    if not expected:
+        return
+    with STATS.timer('verify'):
+        mismatched = verify_files(expected, args.verify_samples)
+    STATS.count('verified', len(expected) - len(mismatched))
+    for result in results:
+        if result['filename'] in mismatched:
+            logger.error(f'Audio changed by the tag write on "{result["filename"]}"')
+            result.update(error='audio mismatch after write', digest=None, key=None)
+            STATS.count('audio_mismatches')
+
+
+def write_plan(plan, args):
+    write_tags(plan, args.writer, args.padding, atomic=args.atomic)
+
+
+def measure_gains(handlers, album=False):
+
+    # ReplayGain tags for the FLAC handlers given, measured only where a
+    # track has no gain yet, album gain only when every track measures
+    # filename -> tags, files missing here get the fixed vinyl bump
+    if not loudness.available():
+        return dict()
+    comments = dict()
+    for handler in handlers:
+        with ignored(Exception):
+            comments[handler.filename] = handler.read()[0]
+    album = album and any('REPLAYGAIN_ALBUM_GAIN' not in comment
+                          for comment in comments.values())
+    measured = dict()
+    for handler in handlers:
+        comment = comments.get(handler.filename)
+        if 'flac' != handler.format or comment is None or \
+           not album and 'REPLAYGAIN_TRACK_GAIN' in comment:
+            continue
+        try:
+            with STATS.timer('loudness'):
+                measured[handler.filename] = loudness.measure(handler.filename,
+                                                              handler.meta.get_streaminfo())
+        except Exception as err:
+            logger.warning(f'No loudness for "{handler.filename}": {err!r}')
+    gains = {filename: loudness.gain_tags([measurement])
+             for filename, measurement in measured.items()}
+    if album and measured and len(measured) == len(handlers):
+        album_tags = loudness.gain_tags(list(measured.values()), 'ALBUM')
+        for tags in gains.values():
+            tags.update(album_tags)
+    return gains
+
+
+def process_file(task, album=None, handler=None, batch=None, gains=None):
+
+    filename, args, known_digest, header = task
+    result = dict(filename=filename, changed=False, error=None, log=[],
+                  digest=None, key=None, rules=None, stats=None, plan=None)
+    read_start = bytes_read()
+    try:
+        if handler is None:
+            with STATS.timer('parse'):
+                # parsed once for the digest and the fixes
+                handler = handler_for(filename, fileobj=header)
+        digest = tag_digest(filename,
+                            metaflac=handler.meta if 'flac' == handler.format else None)
+        if known_digest and digest == known_digest:
+            # tags untouched since they were last fixed
+            logger.debug(f'Unchanged tags on "{filename}"')
+        else:
+            if args.loudness and gains is None:
+                # measured here unless its album was measured as a whole
+                gains = measure_gains([handler]).get(filename)
+            with STATS.timer('rules'):
+                plan = plan_tags(handler, **fix_options(args), album=album, gains=gains)
+            if args.plan:
+                # decided only, the plan is applied later
+                result['plan'] = plan
+                if plan:
+                    plan.update(digest=digest, rules=rules_key(args))
             else:
-                cmd += f' --import-tags-from={tags_file} "{filename}"'
-            run_command(cmd, 1)
-            # cleanup
-            tf.unlink()
+                if plan and args.verify:
+                    # the audio as it is before the write, checked after it
+                    with STATS.timer('verify'):
+                        result['audio'] = meta_audio_digest(handler.meta, args.verify_samples)
+                if plan:
+                    write_tags(plan, args.writer, args.padding, handler, args.atomic, batch)
+                result['changed'] = bool(plan)
+                if result['changed'] and batch is None:
+                    digest = tag_digest(filename)
+                    check_audio([result], args)
+        result['digest'] = digest
+        result['key'] = stat_key(filename)
+    except Exception as err:
+        logger.error(f'Failed on "{filename}": {err!r}')
+        result['error'] = repr(err)
+        STATS.count('errors')
+
+    STATS.count('bytes_read', bytes_read() - read_start)
+    result['rules'] = FLAC_RULES.take_stats()
+    result['stats'] = STATS.take_stats()
+    if log_buffer is not None:
+        result['log'], log_buffer.records = log_buffer.records, []
+    return result
+
+
+def process_album(task):
+
+    # every header in the album is parsed once, the album level decisions
+    # are made from all of them and then each track is fixed
+    folder, file_tasks = task
+    handlers = dict()
+    comments = []
+    for filename, _, _, header in file_tasks:
+        # a file that fails here fails again, and is reported, below
+        with ignored(Exception), STATS.timer('parse'):
+            handlers[filename] = handler_for(filename, fileobj=header)
+            comments.append(handlers[filename].read()[0])
+    album = album_context(folder, comments)
+    logger.debug(f'Album "{folder}": various {album.various}, '
+                 f'albumartist {album.albumartist}, '
+                 f'disc {album.discnumber}/{album.disctotal}, '
+                 f'tracks {album.tracktotal}')
+    args = file_tasks[0][1]
+    batch = None
+    if 'native' != args.writer and not args.plan:
+        # the album's external edits run together once all are planned
+        batch = ToolBatch(args.tool_jobs, STATS.timer)
+    gains = dict()
+    if args.loudness:
+        # album gain needs every track, albums are measured in parallel
+        # by the workers
+        gains = measure_gains(list(handlers.values()), album=True)
+    results = [process_file(file_task, album, handlers.get(file_task[0]), batch,
+                            gains.get(file_task[0], dict()) if args.loudness else None)
+               for file_task in file_tasks]
+    if batch:
+        failed = run_batch(batch)
+        for result in results:
+            if not result['changed'] or result['error']:
+                continue
+            if result['filename'] in failed:
+                logger.error(f'Failed on "{result["filename"]}": external tools failed')
+                result.update(changed=False, error='external tools failed',
+                              digest=None, key=None)
+                STATS.count('errors')
+            else:
+                result['digest'] = tag_digest(result['filename'])
+                result['key'] = stat_key(result['filename'])
+        check_audio(results, args)
+        # the tool timings ride back with the last track
+        STATS.merge_stats(results[-1]['stats'])
+        results[-1]['stats'] = STATS.take_stats()
+        if log_buffer is not None:
+            results[-1]['log'] += log_buffer.records
+            log_buffer.records = []
+    return results
+
+
+def process_artwork(task):
+
+    folder, paths, args = task
+    result = dict(folder=folder, files=len(paths), changed=0, reclaimed=0,
+                  error=None, log=[], stats=None)
+    # picture removal often rewrites the file and moves the audio
+    digests = dict() if args.verify else None
+    try:
+        result['reclaimed'], result['changed'] = \
+            dedupe_album_artwork(folder, paths,
+                                 thumbnail=args.thumbnail,
+                                 padding=args.padding,
+                                 max_padding=args.max_padding,
+                                 digests=digests,
+                                 verify_samples=args.verify_samples)
+    except Exception as err:
+        logger.error(f'Failed on "{folder}": {err!r}')
+        result['error'] = repr(err)
+    if digests:
+        written = [dict(filename=filename, audio=digest, changed=True, error=None)
+                   for filename, digest in digests.items()]
+        check_audio(written, args)
+        if any(file_result['error'] for file_result in written):
+            result['error'] = 'audio mismatch after write'
+
+    result['stats'] = STATS.take_stats()
+    if log_buffer is not None:
+        result['log'], log_buffer.records = log_buffer.records, []
+    return result
+
+
+def apply_entry(task):
+
+    line, plan, args = task
+    filename = plan['path']
+    result = dict(filename=filename, line=line, changed=False, stale=False,
+                  error=None, log=[], digest=None, key=None, stats=None)
+    read_start = bytes_read()
+    try:
+        if tag_digest(filename) != plan['digest']:
+            logger.warning(f'Skipping "{filename}", tags changed since planned')
+            result['stale'] = True
+        else:
+            if args.verify:
+                with STATS.timer('verify'):
+                    result['audio'] = file_audio_digest(filename, args.verify_samples)
+            write_plan(plan, args)
+            result['changed'] = True
+            result['digest'] = tag_digest(filename)
+            result['key'] = stat_key(filename)
+            check_audio([result], args)
+    except Exception as err:
+        logger.error(f'Failed on "{filename}": {err!r}')
+        result['error'] = repr(err)
+        STATS.count('errors')
+
+    STATS.count('bytes_read', bytes_read() - read_start)
+    result['stats'] = STATS.take_stats()
+    if log_buffer is not None:
+        result['log'], log_buffer.records = log_buffer.records, []
+    return result
+
+
+def imap_ordered(pool, fn, iterable, window):
+
+    # like pool.map but only keeps window tasks in flight, so work starts
+    # while the iterable is still being produced
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def journal_check(journal, path):
+    # (skip, recheck) for a file of an interrupted run, done files are
+    # skipped without a stat, in flight ones are checked from scratch
+    if journal is None or not journal.resumed:
+        return False, False
+    if path in journal.done:
+        return True, False
+    if path in journal.in_flight:
+        remove_stale_temps(os.path.dirname(path))
+        return False, True
+    return False, False
+
+
+def run_tasks(pool, pathlist, args, summary, index=None, rule_stats=None,
+              plan_text=None, stats=None, journal=None, results_out=None):
+
+    # results_out, a list, gets each file's result without the records
+    # that are only for this module
+    rules = rules_key(args)
+
+    known_digests = dict()
+
+    def candidates():
+        for path in pathlist:
+            path = str(path)
+            skip, recheck = journal_check(journal, path)
+            if skip:
+                summary['skipped'] += 1
+                continue
+            known_digest = None
+            if index and not args.full and not recheck:
+                clean, known_digest = index.check(path, rules)
+                if clean:
+                    summary['skipped'] += 1
+                    continue
+            known_digests[path] = known_digest
+            if journal:
+                journal.planned(path)
+            yield path
+
+    def tasks():
+        if args.prefetch:
+            headers = prefetch_headers(candidates(), args.prefetch * 1024,
+                                       args.prefetch_threads)
+        else:
+            headers = ((path, None) for path in candidates())
+        for path, header in headers:
+            if isinstance(header, Exception):
+                header = None  # the worker reports the error
+            yield path, args, known_digests.pop(path), header
+
+    def albums():
+        # the walk yields album folders together, an album is only
+        # skipped when every track in it is clean
+        for folder, paths in itertools.groupby(map(str, pathlist), os.path.dirname):
+            file_tasks = []
+            clean_tracks = 0
+            for path in paths:
+                clean, known_digest = False, None
+                skip, recheck = journal_check(journal, path)
+                if skip:
+                    clean = True
+                elif index and not args.full and not recheck:
+                    clean, known_digest = index.check(path, rules)
+                clean_tracks += clean
+                file_tasks.append((path, args, known_digest, None))
+            if clean_tracks == len(file_tasks):
+                summary['skipped'] += clean_tracks
+                continue
+            if journal:
+                for path, _, _, _ in file_tasks:
+                    journal.planned(path)
+            yield folder, file_tasks
+
+    def album_tasks():
+        if not args.prefetch:
+            yield from albums()
+            return
+        # the tracks of the albums to fix are prefetched in one stream,
+        # across album boundaries, and handed back album by album
+        pending = deque()
+
+        def album_paths():
+            for album in albums():
+                pending.append(album)
+                for path, _, _, _ in album[1]:
+                    yield path
+
+        file_tasks = []
+        for path, header in prefetch_headers(album_paths(), args.prefetch * 1024,
+                                             args.prefetch_threads):
+            if isinstance(header, Exception):
+                header = None  # the worker reports the error
+            folder, planned = pending[0]
+            _, _, known_digest, _ = planned[len(file_tasks)]
+            file_tasks.append((path, args, known_digest, header))
+            if len(file_tasks) == len(planned):
+                pending.popleft()
+                yield folder, file_tasks
+                file_tasks = []
+
+    if args.albums:
+        if pool:
+            batches = imap_ordered(pool, process_album, album_tasks(), 2 * args.jobs)
+        else:
+            batches = map(process_album, album_tasks())
+        results = (result for batch in batches for result in batch)
+    elif pool:
+        results = imap_ordered(pool, process_file, tasks(), 4 * args.jobs)
+    else:
+        results = map(process_file, tasks())
+
+    # results come back in submission order whatever the worker count
+    for result in results:
+        for record in result.pop('log'):
+            logging.getLogger(record.name).handle(record)
+        summary['scanned'] += 1
+        rule_hits, stage_stats = result.pop('rules'), result.pop('stats')
+        if rule_stats:
+            rule_stats.merge_stats(rule_hits)
+        if stats:
+            stats.merge_stats(stage_stats)
+        if results_out is not None:
+            results_out.append(result)
+        if result['error']:
+            summary['failed'] += 1
+            if index:
+                index.forget(result['filename'])
+            if journal:
+                journal.failed(result['filename'])
+            continue
+        if args.plan:
+            if result['plan']:
+                if plan_text:
+                    plan_text.write(json.dumps(result['plan']) + '\n')
+                summary['planned'] += 1
+            continue
+        if result['changed']:
+            summary['changed'] += 1
+        if index:
+            index.record(result['filename'], result['key'],
+                         result['digest'], rules)
+        if journal:
+            journal.committed(result['filename'])
+
+
+def apply_plan(pool, args, summary, index=None, stats=None):
+
+    # applied line numbers go to a progress file so an interrupted apply
+    # picks up after the last entry it wrote
+    progress_name = args.apply + '.done'
+    done = set()
+    if os.path.exists(progress_name):
+        with io.open(progress_name) as progress:
+            done = {int(line) for line in progress if line.strip()}
+
+    with io.open(args.apply) as plan_text:
+        entries = [(line, json.loads(text))
+                   for line, text in enumerate(plan_text) if text.strip()]
+    # bulk by directory, plan order within a directory
+    entries.sort(key=lambda entry: (os.path.dirname(entry[1]['path']), entry[0]))
+
+    entries_by_line = dict(entries)
+    tasks = ((line, plan, args) for line, plan in entries if line not in done)
+    summary['skipped'] += len(done)
+    if pool:
+        results = imap_ordered(pool, apply_entry, tasks, 4 * args.jobs)
+    else:
+        results = map(apply_entry, tasks)
+
+    with io.open(progress_name, 'a') as progress:
+        for result in results:
+            for record in result['log']:
+                logging.getLogger(record.name).handle(record)
+            summary['scanned'] += 1
+            stats.merge_stats(result['stats'])
+            if result['error']:
+                summary['failed'] += 1
+                continue
+            if result['stale']:
+                summary['stale'] += 1
+            elif result['changed']:
+                summary['changed'] += 1
+                if index:
+                    plan = entries_by_line[result['line']]
+                    index.record(result['filename'], result['key'],
+                                 result['digest'], plan['rules'])
+            progress.write(f"{result['line']}\n")
+            progress.flush()
+
+
+def header_batch(entry_fn, paths):
+
+    # worker side of scan_headers, (path, entry, error) per path
+    results = []
+    for path in paths:
+        try:
+            results.append((path, entry_fn(path), None))
+        except Exception as err:
+            results.append((path, None, repr(err)))
+    return results
+
+
+def scan_headers(pool, pathlist, args, summary, entry_fn):
+
+    # header reads only, yields (path, entry_fn(path)) in walk order and
+    # counts and logs the failures; files go to the workers in batches
+    # as one file is too little work to be worth a round trip
+    paths = map(str, pathlist)
+    batches = iter(lambda: list(itertools.islice(paths, 256)), [])
+    read_batch = functools.partial(header_batch, entry_fn)
+    if pool:
+        results = imap_ordered(pool, read_batch, batches, 4 * args.jobs)
+    else:
+        results = map(read_batch, batches)
+
+    for batch in results:
+        for filename, entry, error in batch:
+            summary['scanned'] += 1
+            if error:
+                logger.error(f'Failed on "{filename}": {error}')
+                summary['failed'] += 1
+                continue
+            yield filename, entry
+
+
+def catalog_library(pool, pathlist, args, summary):
+
+    catalog = Catalog()
+    for filename, row in scan_headers(pool, pathlist, args, summary, catalog_entry):
+        catalog.append(row)
+
+    for catalog_name in catalog.write(args.catalog):
+        logger.info(f'Catalog of {len(catalog)} files written to {catalog_name}')
+    for (fmt, rate, bits), (files, seconds, size) in sorted(catalog.summary().items()):
+        logger.info(f'{fmt} {rate}Hz {bits}bit: {files} files, '
+                    f'{seconds / 3600:.1f} hours, {size / 2 ** 30:.2f} GiB')
+
+
+def duplicates_library(pool, pathlist, args, summary):
+
+    duplicates = DuplicateIndex()
+    for filename, entry in scan_headers(pool, pathlist, args, summary, duplicate_entry):
+        duplicates.add(filename, entry)
+
+    exact, near = duplicates.write(args.duplicates)
+    logger.info(f'{exact} sets of identical audio and {near} sets of likely '
+                f'duplicates among {len(duplicates)} files')
+
+
+def find_library(pool, pathlist, args, summary):
+
+    # one header pass into an in-memory TagStore, then the query, KEY=VALUE
+    # for an exact value or KEY~TEXT for values containing TEXT
+    query = re.match(r'([^=~]+)([=~])(.*)\Z', args.find, re.DOTALL)
+    if not query:
+        raise ValueError(f'--find wants KEY=VALUE or KEY~TEXT, not "{args.find}"')
+    key, sep, text = query.groups()
+
+    store = TagStore()
+    for filename, pairs in scan_headers(pool, pathlist, args, summary, tag_pairs):
+        store.add(filename, pairs)
+
+    keys, values, pairs = store.counts()
+    logger.info(f'{len(store)} files, {pairs} tags, {keys} distinct keys, '
+                f'{values} distinct values')
+    tracks = store.search(key, text) if '~' == sep else store.find(key, text)
+    for track in tracks:
+        print(store.path(track))
+    logger.info(f'{len(tracks)} files match {args.find}')
+
+
+def artwork_library(pool, pathlist, args, summary, stats):
+
+    # album folder by album folder, the walk yields them together
+    tasks = ((folder, list(paths), args)
+             for folder, paths in itertools.groupby(map(str, pathlist), os.path.dirname))
+    if pool:
+        results = imap_ordered(pool, process_artwork, tasks, 2 * args.jobs)
+    else:
+        results = map(process_artwork, tasks)
+
+    for result in results:
+        for record in result['log']:
+            logging.getLogger(record.name).handle(record)
+        stats.merge_stats(result['stats'])
+        summary['scanned'] += result['files']
+        summary['changed'] += result['changed']
+        summary['reclaimed'] += result['reclaimed']
+        if result['error']:
+            summary['failed'] += 1
+    logger.info(f"Reclaimed {summary['reclaimed'] / 2 ** 20:.1f} MiB of embedded artwork")
+
+
+def watch_library(pool, args, summary, index=None, rule_stats=None,
+                  stats=None):
+
+    # runs until interrupted, each album directory is fixed once it has
+    # been quiet for --settle seconds
+    logger.info(f'Watching {args.folder} for new FLAC and DSF')
+    with LibraryWatcher(args.folder, args.settle, args.depth) as watcher:
+        try:
+            for paths in watcher.batches():
+                logger.info(f'Fixing {len(paths)} files in '
+                            f'{os.path.dirname(paths[0])}')
+                run_tasks(pool, paths, args, summary, index, rule_stats,
+                          None, stats)
+                watcher.settled(paths)
+                if index:
+                    index.commit()
+        except KeyboardInterrupt:
+            logger.info(f'Stopped watching {args.folder}')
+
+
+def fix_paths(paths, options=None, pool=None):
+
+    # library entry point, fixes the FLAC and DSF files in paths and
+    # returns a result dict per file: filename, changed, error, digest,
+    # key and plan (options.plan makes it plan only, nothing is written)
+    # the work is done in this process unless a ProcessPoolExecutor
+    # started with init_worker is passed in, logging goes to the
+    # fixflactag logger and is left to the caller to configure
+    options = options or Options()
+    summary = Counter()
+    results = []
+    index = ScanIndex(options.index) if options.index else None
+    try:
+        run_tasks(pool, [str(path) for path in paths], options, summary, index,
+                  results_out=results)
+    finally:
+        if index:
+            index.close()
+    return results
 
 
 def main(args):
 
-    logging.info('Processing FLAC')
-    pathlist = Path(args.folder).glob('*/*.flac')
-    for path in sorted(pathlist):
-        fix_flac_tags(str(path),
-                      isvarious=args.various,
-                      discnumber=args.discnumber,
-                      disctotal=args.disctotal,
-                      tracktotal=args.tracktotal,
-                      swaptags=args.swap)
-
-    logging.info('Processing DSF')
-    pathlist = Path(args.folder).glob('*/*.dsf')
-    for path in sorted(pathlist):
-        fix_dsf_tags(str(path),
-                     isvarious=args.various,
-                     discnumber=args.discnumber,
-                     disctotal=args.disctotal,
-                     tracktotal=args.tracktotal,
-                     swaptags=args.swap)
+    summary = Counter()
+    rule_stats = RuleSet()
+    # every result hands its stats back, in-process ones included
+    stats = STATS
+    stats.reset_stats()
+    start, read_start = time.perf_counter(), bytes_read()
+    if args.loudness and not loudness.available():
+        logger.warning('--loudness needs numpy, scipy and libsndfile or flac, '
+                       'vinyl rips get the fixed gain')
+    pool = None
+    if args.jobs > 1:
+        pool = ProcessPoolExecutor(args.jobs, initializer=init_worker)
+
+    index = None
+    if args.index != '-' and \
+       not (args.catalog or args.artwork or args.duplicates or args.find) and \
+       (args.index or args.folder):
+        index = ScanIndex(args.index or os.path.join(args.folder, '.fixflactag.db'))
+
+    journal = None
+    fixing = not (args.apply or args.plan or args.catalog or args.artwork or
+                  args.duplicates or args.find or args.watch)
+    if fixing and args.journal != '-' and (args.journal or args.folder):
+        journal = Journal(args.journal or os.path.join(args.folder, '.fixflactag.journal'))
+        if journal.resumed:
+            logger.info(f'Resuming interrupted run, {len(journal.done)} files done, '
+                        f'{len(journal.in_flight)} to recheck')
+
+    plan_text = None
+    try:
+        if args.apply:
+            logger.info(f'Applying {args.apply}')
+            apply_plan(pool, args, summary, index, stats)
+        elif args.catalog:
+            logger.info(f'Cataloguing FLAC and DSF in {args.folder}')
+            pathlist = stats.timed('walk', walk_library(args.folder, args.depth))
+            catalog_library(pool, pathlist, args, summary)
+        elif args.duplicates:
+            logger.info(f'Looking for duplicate rips in {args.folder}')
+            pathlist = stats.timed('walk', walk_library(args.folder, args.depth))
+            duplicates_library(pool, pathlist, args, summary)
+        elif args.find:
+            logger.info(f'Loading the tags of {args.folder}')
+            pathlist = stats.timed('walk', walk_library(args.folder, args.depth))
+            find_library(pool, pathlist, args, summary)
+        elif args.artwork:
+            logger.info(f'Externalizing shared artwork in {args.folder}')
+            pathlist = stats.timed('walk', walk_library(args.folder, args.depth))
+            artwork_library(pool, pathlist, args, summary, stats)
+        elif args.watch:
+            watch_library(pool, args, summary, index, rule_stats, stats)
+        else:
+            if args.plan:
+                plan_text = io.open(args.plan, 'w')
+                # apply progress of an earlier plan written here would
+                # skip this plan's lines by number
+                with ignored(FileNotFoundError):
+                    os.unlink(args.plan + '.done')
+            logger.info(f'Processing FLAC and DSF in {args.folder}')
+            pathlist = stats.timed('walk', walk_library(args.folder, args.depth))
+            run_tasks(pool, pathlist, args, summary, index, rule_stats,
+                      plan_text, stats, journal)
+        if journal:
+            # index first, the journal then no longer matters
+            if index:
+                index.commit()
+            journal.complete()
+    finally:
+        if journal:
+            journal.close()
+        if plan_text:
+            plan_text.close()
+        if pool:
+            pool.shutdown()
+        if index:
+            index.close()
+
+    logger.info(f"Scanned {summary['scanned']} files, "
+                f"skipped {summary['skipped']}, "
+                f"planned {summary['planned']}, "
+                f"changed {summary['changed']}, "
+                f"stale {summary['stale']}, "
+                f"failed {summary['failed']}")
+    if args.verify:
+        logger.info(f"Verified audio of {stats.counters['verified']} writes, "
+                    f"{stats.counters['audio_mismatches']} mismatches")
+    if args.rule_stats:
+        rule_stats.report()
+
+    if args.stats or args.prometheus:
+        if pool:
+            # this process only walked, prefetched and indexed
+            stats.count('bytes_read', bytes_read() - read_start)
+        else:
+            stats.counters['bytes_read'] = bytes_read() - read_start
+        report = stats.report(summary, time.perf_counter() - start)
+        if args.stats:
+            write_json(report, args.stats)
+        if args.prometheus:
+            write_prometheus(report, args.prometheus)
+    return summary
 
 
 log_file = '/tmp/flactag.log'
-parser = argparse.ArgumentParser()
-
-parser.add_argument('--folder', '-f',
-                    help='Folder to process',
-                    type=str)
-parser.add_argument('--various', '-v',
-                    help='Is Various Artists',
-                    type=int,
-                    default=0)
-parser.add_argument('--backup', '-b',
-                    help='Backup original files',
-                    type=int,
-                    default=0)
-parser.add_argument('--discnumber', '-n',
-                    help='Disc Number',
-                    type=int,
-                    default=1)
-parser.add_argument('--disctotal', '-d',
-                    help='Disc Total',
-                    type=int,
-                    default=1)
-parser.add_argument('--swap', '-s',
-                    help='Swap Artist and Title',
-                    type=int,
-                    default=0)
-parser.add_argument('--tracktotal', '-t',
-                    help='Track Total',
-                    type=int,
-                    default=0)
-
-args = parser.parse_args()
+
+
+def build_parser():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--folder', '-f',
+                        help='Folder to process',
+                        type=str)
+    parser.add_argument('--various', '-v',
+                        help='Is Various Artists',
+                        type=int,
+                        default=0)
+    parser.add_argument('--backup', '-b',
+                        help='Backup original files',
+                        type=int,
+                        default=0)
+    parser.add_argument('--discnumber', '-n',
+                        help='Disc Number',
+                        type=int,
+                        default=1)
+    parser.add_argument('--disctotal', '-d',
+                        help='Disc Total',
+                        type=int,
+                        default=1)
+    parser.add_argument('--swap', '-s',
+                        help='Swap Artist and Title',
+                        type=int,
+                        default=0)
+    parser.add_argument('--tracktotal', '-t',
+                        help='Track Total',
+                        type=int,
+                        default=0)
+    parser.add_argument('--writer', '-w',
+                        help='Tag writer, native or the external metaflac/metadsf utilities',
+                        choices=('native', 'external'),
+                        default='native')
+    parser.add_argument('--padding', '-p',
+                        help='Padding to leave when a FLAC has to be rewritten',
+                        type=int,
+                        default=8192)
+    parser.add_argument('--tool-jobs',
+                        help='External writer calls to run at once, per worker',
+                        type=int,
+                        default=4)
+    parser.add_argument('--verify',
+                        help='Hash the audio of every file written before and after the write and fail it on any difference',
+                        action='store_true')
+    parser.add_argument('--verify-samples',
+                        help='With --verify hash only the first and last MiB of the audio and this many random MiB extents',
+                        type=int,
+                        default=0)
+    parser.add_argument('--loudness',
+                        help='Measure ReplayGain 2.0 track gain and peak (album too with --albums) for files without, in place of the fixed vinyl bump, needs numpy and scipy',
+                        action='store_true')
+    parser.add_argument('--jobs', '-j',
+                        help='Worker processes',
+                        type=int,
+                        default=1)
+    parser.add_argument('--depth',
+                        help='Folder levels to search below --folder',
+                        type=int,
+                        default=3)
+    parser.add_argument('--albums', '-a',
+                        help='Work album folder by album folder, deciding compilation, disc and track totals and album artist once per album',
+                        action='store_true')
+    parser.add_argument('--prefetch',
+                        help='Prefetch this many KB of each FLAC header concurrently, 0 disables',
+                        type=int,
+                        default=0)
+    parser.add_argument('--prefetch-threads',
+                        help='Concurrent header reads when prefetching',
+                        type=int,
+                        default=16)
+    parser.add_argument('--index', '-i',
+                        help='Scan index, defaults to .fixflactag.db in the folder, - to disable',
+                        type=str,
+                        default=None)
+    parser.add_argument('--full',
+                        help='Ignore the scan index and recheck every file',
+                        action='store_true')
+    parser.add_argument('--journal',
+                        help='Run journal, an interrupted run resumes from it, defaults to .fixflactag.journal in the folder, - to disable',
+                        type=str,
+                        default=None)
+    parser.add_argument('--atomic',
+                        help='Never write tags in place, always write a temp file, fsync and rename it over the original',
+                        action='store_true')
+    parser.add_argument('--plan',
+                        help='Write the changes to this JSON lines file instead of applying them',
+                        type=str,
+                        default=None)
+    parser.add_argument('--apply',
+                        help='Apply a plan written by --plan, resuming if interrupted',
+                        type=str,
+                        default=None)
+    parser.add_argument('--catalog',
+                        help='Only catalog stream properties, writes CATALOG.csv plus CATALOG.parquet (pyarrow) or CATALOG.npz (numpy)',
+                        type=str,
+                        default=None)
+    parser.add_argument('--duplicates',
+                        help='Only look for duplicate rips, by STREAMINFO MD5 and by artist, album, title and duration, and write them to DUPLICATES as JSON lines (- for stdout)',
+                        type=str,
+                        default=None)
+    parser.add_argument('--find',
+                        help='Only list the files whose tags match, KEY=VALUE for an exact value, KEY~TEXT for values containing TEXT (any case)',
+                        type=str,
+                        default=None)
+    parser.add_argument('--artwork',
+                        help='Only move artwork shared by an album\'s tracks to folder.jpg and drop the embedded copies',
+                        action='store_true')
+    parser.add_argument('--thumbnail',
+                        help='With --artwork keep an embedded thumbnail of this many pixels (needs Pillow), 0 for none',
+                        type=int,
+                        default=0)
+    parser.add_argument('--max-padding',
+                        help='With --artwork rewrite rather than leave more than this much padding in place',
+                        type=int,
+                        default=65536)
+    parser.add_argument('--watch',
+                        help='Keep running and fix files as they are written below --folder (Linux inotify)',
+                        action='store_true')
+    parser.add_argument('--settle',
+                        help='Seconds an album folder has to be quiet before --watch fixes it',
+                        type=float,
+                        default=5.0)
+    parser.add_argument('--rule-stats',
+                        help='Report hits per cleanup rule and rule time per tag field',
+                        action='store_true')
+    parser.add_argument('--stats',
+                        help='Write stage timings (p50/p95/p99) and counters as JSON to this file, - for stdout',
+                        type=str,
+                        default=None)
+    parser.add_argument('--prometheus',
+                        help='Write the same report for the Prometheus node exporter textfile collector to this file',
+                        type=str,
+                        default=None)
+    return parser
+
 
 if __name__ == "__main__":
 
@@ -410,6 +1277,6 @@ if __name__ == "__main__":
 
     logging.getLogger('').addHandler(console)
 
-    main(args)
+    main(Options(**vars(build_parser().parse_args())))
 
-sys.exit(0)
+    sys.exit(0)
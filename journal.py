@@ -0,0 +1,91 @@
+import io
+import os
+import json
+
+# append-only run journal, one JSON line per event
+# {"path": ..., "state": "planned"}    the file was handed to a worker
+# {"path": ..., "state": "committed"}  it is fixed, or was clean
+# {"path": ..., "state": "failed"}
+# {"state": "complete"}                the run finished
+# a journal not ending in complete belongs to an interrupted run, the
+# next run skips the files it committed and rechecks the ones in flight
+# lines are flushed as written so they survive the process being killed,
+# fsync is batched
+
+
+class Journal:
+
+    def __init__(self, filename, sync_every=256):
+        self.filename = filename
+        # from an interrupted run, files committed and files in flight
+        self.done = set()
+        self.in_flight = set()
+        self.resumed = False
+        torn = False
+        if os.path.exists(filename):
+            torn = self.__load()
+        self.__file = io.open(filename, 'a' if self.resumed else 'w')
+        if torn and self.resumed:
+            self.__file.write('\n')
+        self.__sync_every = sync_every
+        self.__unsynced = 0
+
+    def __load(self):
+        # returns True when the last line was cut short
+        planned, committed = set(), set()
+        complete = False
+        text = ''
+        with io.open(self.filename) as journal:
+            for text in journal:
+                try:
+                    entry = json.loads(text)
+                except ValueError:
+                    continue  # torn last line
+                state = entry.get('state')
+                if 'complete' == state:
+                    planned, committed = set(), set()
+                    complete = True
+                    continue
+                complete = False
+                if 'planned' == state:
+                    planned.add(entry['path'])
+                elif 'committed' == state:
+                    planned.discard(entry['path'])
+                    committed.add(entry['path'])
+                elif 'failed' == state:
+                    # tried again on resume
+                    planned.discard(entry['path'])
+        if not complete and (planned or committed):
+            self.resumed = True
+            self.done = committed
+            self.in_flight = planned
+        return bool(text) and not text.endswith('\n')
+
+    def __write(self, entry):
+        self.__file.write(json.dumps(entry) + '\n')
+        self.__file.flush()
+        self.__unsynced += 1
+        if self.__unsynced >= self.__sync_every:
+            self.sync()
+
+    def sync(self):
+        os.fsync(self.__file.fileno())
+        self.__unsynced = 0
+
+    def planned(self, path):
+        self.__write(dict(path=path, state='planned'))
+
+    def committed(self, path):
+        self.__write(dict(path=path, state='committed'))
+
+    def failed(self, path):
+        self.__write(dict(path=path, state='failed'))
+
+    def complete(self):
+        self.__write(dict(state='complete'))
+        self.close()
+
+    def close(self):
+        if not self.__file.closed:
+            self.sync()
+            self.__file.close()
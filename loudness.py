@@ -0,0 +1,170 @@
+import shutil
+import logging
+import subprocess
+from collections import namedtuple
+
+logger = logging.getLogger('fixflactag.loudness')
+
+# ReplayGain 2.0 loudness, ITU-R BS.1770 / EBU R128 integrated loudness
+# PCM is decoded with libsndfile (soundfile) when installed, else piped
+# from flac -d, and analysed in frames of several seconds: K-weighting
+# with scipy, the mean square of every 100 ms sub-block with numpy, 400 ms
+# blocks overlapping by 75% are four sub-blocks averaged
+# a track is measured down to its block energies and sample peak, so an
+# album's loudness is gated over the blocks of all its tracks
+# needs numpy and scipy, available() says whether measuring is possible
+# they are imported on first use, scipy.signal alone takes about a second
+# and most runs never measure
+
+numpy = scipy = soundfile = None
+_loaded = False
+
+
+def _load():
+    global numpy, scipy, soundfile, _loaded
+    if _loaded:
+        return
+    _loaded = True
+    try:
+        import numpy
+    except ImportError:
+        pass
+    try:
+        import scipy.signal
+    except ImportError:
+        pass
+    try:
+        import soundfile
+    except (ImportError, OSError):
+        pass
+
+REFERENCE = -18.0  # LUFS, ReplayGain 2.0
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+FRAME_SECONDS = 10  # decoded and filtered at a time
+
+# block energies (one per 400 ms block) and the sample peak
+Measurement = namedtuple('Measurement', 'energies peak')
+
+
+def available():
+    _load()
+    return numpy is not None and scipy is not None and \
+        (soundfile is not None or shutil.which('flac') is not None)
+
+
+def k_weighting(rate):
+    # the BS.1770 shelf and high pass for any sample rate, as second
+    # order sections
+    f0, gain, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = numpy.tan(numpy.pi * f0 / rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0,
+             (vh - vb * k / q + k * k) / a0,
+             1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = numpy.tan(numpy.pi * f0 / rate)
+    a0 = 1 + k / q + k * k
+    high_pass = [1.0, -2.0, 1.0,
+                 1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0]
+    return numpy.array([shelf, high_pass])
+
+
+def channel_weights(channels):
+    # 5.1 in FLAC order, FL FR FC LFE BL BR, the LFE is left out and the
+    # surrounds weighted up
+    if 6 == channels:
+        return numpy.array([1.0, 1.0, 1.0, 0.0, 1.41, 1.41])
+    return numpy.ones(channels)
+
+
+def _flac_frames(filename, channels, bits, frames):
+    # raw little endian PCM from the flac decoder, as floats in [-1, 1)
+    width = (bits + 7) // 8
+    frame_bytes = frames * channels * width
+    scale = float(1 << (8 * width - 1))
+    argv = ['flac', '--decode', '--stdout', '--silent', '--force-raw-format',
+            '--endian=little', '--sign=signed', '--', filename]
+    with subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+        while True:
+            data = proc.stdout.read(frame_bytes)
+            usable = len(data) - len(data) % (channels * width)
+            if not usable:
+                break
+            raw = numpy.frombuffer(data[:usable], numpy.uint8)
+            if 3 == width:
+                # no 24 bit dtype, widen to 32 bit with the sign carried
+                raw = raw.reshape(-1, 3)
+                pcm = numpy.zeros((len(raw), 4), numpy.uint8)
+                pcm[:, 1:] = raw
+                samples = pcm.view('<i4').ravel() >> 8
+            else:
+                samples = raw.view(f'<i{width}') if width > 1 else raw.view(numpy.int8)
+            yield samples.reshape(-1, channels) / scale
+        if proc.wait():
+            raise RuntimeError(f'flac exit {proc.returncode} decoding "{filename}"')
+
+
+def pcm_frames(filename, channels, bits, frames):
+    if soundfile is not None:
+        yield from soundfile.blocks(filename, blocksize=frames, dtype='float64',
+                                    always_2d=True)
+    else:
+        yield from _flac_frames(filename, channels, bits, frames)
+
+
+def measure(filename, streaminfo):
+    # streaminfo as MetaFlac.get_streaminfo returns it
+    _load()
+    rate = streaminfo['sample_rate']
+    channels = streaminfo['number_of_channels']
+    hop = rate // 10
+    sos = k_weighting(rate)
+    # sosfilt along axis 0 keeps (sections, 2, channels) of state
+    state = numpy.zeros((len(sos), 2, channels))
+    weights = channel_weights(channels)
+    sub_blocks = []
+    peak = 0.0
+    rest = numpy.zeros((0, channels))
+    for samples in pcm_frames(filename, channels, streaminfo['bits_per_sample'],
+                              FRAME_SECONDS * rate):
+        if not len(samples):
+            continue
+        peak = max(peak, float(numpy.abs(samples).max()))
+        filtered, state = scipy.signal.sosfilt(sos, samples, axis=0, zi=state)
+        filtered = numpy.concatenate((rest, filtered))
+        whole = len(filtered) // hop * hop
+        squares = numpy.square(filtered[:whole]).reshape(-1, hop, channels).mean(axis=1)
+        sub_blocks.append(squares @ weights)
+        rest = filtered[whole:]
+    energies = numpy.concatenate(sub_blocks) if sub_blocks else numpy.zeros(0)
+    if len(energies) < 4:
+        return Measurement(numpy.zeros(0), peak)
+    # 400 ms blocks every 100 ms
+    windows = numpy.lib.stride_tricks.sliding_window_view(energies, 4)
+    return Measurement(windows.mean(axis=1), peak)
+
+
+def integrated_loudness(energies):
+    # gated loudness in LUFS, None for silence or nothing measured
+    energies = energies[energies > 0]
+    if not len(energies):
+        return None
+    loudness = -0.691 + 10 * numpy.log10(energies)
+    energies, loudness = energies[loudness > ABSOLUTE_GATE], loudness[loudness > ABSOLUTE_GATE]
+    if not len(energies):
+        return None
+    gate = -0.691 + 10 * numpy.log10(energies.mean()) + RELATIVE_GATE
+    return -0.691 + 10 * numpy.log10(energies[loudness > gate].mean())
+
+
+def gain_tags(measurements, scope='TRACK'):
+    # REPLAYGAIN_<scope>_GAIN and _PEAK from one or more measurements,
+    # empty when there is nothing to go on
+    loudness = integrated_loudness(numpy.concatenate([m.energies for m in measurements]))
+    if loudness is None:
+        return dict()
+    return {f'REPLAYGAIN_{scope}_GAIN': f'{REFERENCE - loudness:+.2f} dB',
+            f'REPLAYGAIN_{scope}_PEAK': f'{max(m.peak for m in measurements):.6f}'}
@@ -1,8 +1,63 @@
 import io
-import subprocess
+import os
+import struct
 from pathlib import Path
+from safewrite import copy_range, atomic_write
 
-# class wrapper for metadsf CLI utility.
+# https://dsd-guide.com/sites/default/files/white-papers/DSFFileFormatSpec_E.pdf
+# All numbers in the DSF chunks are little-endian coded.
+# The metadata chunk is an ID3v2 tag that runs from the metadata
+# pointer to the end of the file.
+# https://id3.org/id3v2.3.0 https://id3.org/id3v2.4.0-structure
+
+
+class MetaDsfException(Exception):
+    pass
+
+
+def _read(file, nbytes):  # helper function to check if we haven't reached EOF
+    b = file.read(nbytes)
+    if len(b) < nbytes:
+        raise MetaDsfException('Unexpected end of file')
+    return b
+
+
+def _syncsafe(bytestr):
+    return (bytestr[0] << 21) | (bytestr[1] << 14) | (bytestr[2] << 7) | bytestr[3]
+
+
+def _to_syncsafe(size):
+    if size >= 1 << 28:
+        raise MetaDsfException('ID3 tag too large')
+    return bytes(((size >> 21) & 0x7f, (size >> 14) & 0x7f, (size >> 7) & 0x7f, size & 0x7f))
+
+
+def _deunsync(data):
+    return data.replace(b'\xff\x00', b'\xff')
+
+
+# text encodings by ID3 encoding byte and their string terminator
+_ENCODINGS = {0: ('latin-1', b'\x00'),
+              1: ('utf-16', b'\x00\x00'),
+              2: ('utf-16-be', b'\x00\x00'),
+              3: ('utf-8', b'\x00')}
+
+
+def _split_terminated(data, encoding):
+    # split off a terminated string, honouring 2-byte terminators
+    terminator = _ENCODINGS[encoding][1]
+    step = len(terminator)
+    for idx in range(0, len(data) - step + 1, step):
+        if data[idx:idx + step] == terminator:
+            return data[:idx], data[idx + step:]
+    return data, b''
+
+
+def _decode_text(encoding, data):
+    text = data.decode(_ENCODINGS[encoding][0], 'replace')
+    # multiple values are null separated
+    values = [value for value in text.split('\x00') if value]
+    return '/'.join(values)
 
 
 class MetaDsf:
@@ -17,27 +72,226 @@ class MetaDsf:
         else:
             raise FileExistsError('invalid, file does not exist')
 
-    def get_id3_tags(self):
+        self.__new_id3_tags = None
+        self.__parse()
+
+    def __parse(self):
+        self.__version = 3
+        # (frame_id, flags, payload, key, value) in tag order,
+        # key is set for the frames get_id3_tags exposes
+        self.__frames = []
+
+        with io.open(self.filename, 'rb') as file:
+            # DSD chunk header, the rest of the file is never touched
+            header = _read(file, 28)
+            if header[0:4] != b'DSD ':
+                raise MetaDsfException(f'{header[0:4]} is not valid dsf header on {self.filename}')
+            self.__file_size, self.__metadata_offset = struct.unpack('<QQ', header[12:28])
+            # fmt chunk, it follows the DSD chunk
+            self.__block_fmt = _read(file, 52)
+            if self.__block_fmt[0:4] != b'fmt ':
+                raise MetaDsfException(f'{self.__block_fmt[0:4]} is not valid fmt chunk on {self.filename}')
+
+            if not self.__metadata_offset:
+                # no tag yet, one would go after the data chunk
+                fmt_size = struct.unpack('<Q', self.__block_fmt[4:12])[0]
+                file.seek(28 + fmt_size)
+                data = _read(file, 12)
+                self.__tag_offset = 28 + fmt_size + struct.unpack('<Q', data[4:12])[0]
+                return
+
+            self.__tag_offset = self.__metadata_offset
+            file.seek(self.__metadata_offset)
+            self.__block_id3_tags = file.read()
+
+        self.__parse_id3()
+
+    def __parse_id3(self):
+        block = self.__block_id3_tags
+        if len(block) < 10 or block[0:3] != b'ID3':
+            raise MetaDsfException(f'invalid ID3 tag on {self.filename}')
+        version, flags = block[3], block[5]
+        if version not in (3, 4):
+            raise NotImplementedError(f'ID3v2.{version} tags are not supported')
+        self.__version = version
+        data = block[10:10 + _syncsafe(block[6:10])]
+
+        if flags & 0x80 and 3 == version:
+            # tag level unsynchronisation only exists in 2.3
+            data = _deunsync(data)
 
-        cmd = ['metadsf -t -eUTF8 "{}"'.format(self.filename)]
-        proc = subprocess.Popen(cmd,
-                                stdout=subprocess.PIPE,
-                                shell=True)
+        pos = 0
+        if flags & 0x40:
+            # skip the extended header
+            if 3 == version:
+                pos = 4 + struct.unpack('>I', data[0:4])[0]
+            else:
+                pos = _syncsafe(data[0:4])
+
+        keys = set()
+        while pos + 10 <= len(data):
+            frame_id = data[pos:pos + 4]
+            if frame_id[0] == 0:
+                break  # padding
+            if 4 == version:
+                size = _syncsafe(data[pos + 4:pos + 8])
+            else:
+                size = struct.unpack('>I', data[pos + 4:pos + 8])[0]
+            frame_flags = data[pos + 8:pos + 10]
+            payload = data[pos + 10:pos + 10 + size]
+            pos += 10 + size
+
+            key = value = None
+            try:
+                key, value = self.__decode_frame(frame_id, frame_flags, payload)
+            except (KeyError, IndexError, UnicodeError):
+                pass
+            if key in keys:
+                key = value = None  # first one wins, later ones are kept as is
+            if key:
+                keys.add(key)
+            self.__frames.append((frame_id, frame_flags, payload, key, value))
+
+    def __decode_frame(self, frame_id, frame_flags, payload):
+        if 4 == self.__version:
+            if frame_flags[1] & 0x0c:
+                return None, None  # compressed or encrypted
+            if frame_flags[1] & 0x40:
+                payload = payload[1:]  # group id
+            if frame_flags[1] & 0x02:
+                payload = _deunsync(payload)
+            if frame_flags[1] & 0x01:
+                payload = payload[4:]  # data length indicator
+        elif frame_flags[1] & 0xe0:
+            return None, None  # compressed, encrypted or grouped
+
+        key = frame_id.decode('latin-1')
+        if 'TXXX' == key:
+            # user defined text, exposed as TXXX:description
+            description, text = _split_terminated(payload[1:], payload[0])
+            return f'TXXX:{_decode_text(payload[0], description)}', _decode_text(payload[0], text)
+        if key.startswith('T'):
+            return key, _decode_text(payload[0], payload[1:])
+        if 'COMM' == key:
+            # encoding, language, short description then the comment
+            description, text = _split_terminated(payload[4:], payload[0])
+            if _decode_text(payload[0], description):
+                return None, None
+            return key, _decode_text(payload[0], text)
+        return None, None
+
+    def __encode_frame(self, key, value):
+        if 4 == self.__version:
+            encoding, codec, terminator = 3, 'utf-8', b'\x00'
+        else:
+            # 2.3 has no utf-8
+            encoding, codec, terminator = 1, 'utf-16', b'\x00\x00'
+        text = value.encode(codec)
+        if 'COMM' == key:
+            payload = bytes((encoding,)) + b'eng' + ''.encode(codec) + terminator + text
+        elif key.startswith('TXXX:'):
+            payload = bytes((encoding,)) + key[5:].encode(codec) + terminator + text
+            key = 'TXXX'
+        else:
+            payload = bytes((encoding,)) + text
+        return key.encode('latin-1'), b'\x00\x00', payload
+
+    def get_streaminfo(self):
+        # the fmt chunk, keyed like MetaFlac.get_streaminfo
+        block = self.__block_fmt
+        streaminfo = dict()
+        streaminfo['format_version'] = struct.unpack('<I', block[12:16])[0]  # 1
+        streaminfo['channel_type'] = struct.unpack('<I', block[20:24])[0]  # 1 mono, 2 stereo ... 7 5.1
+        streaminfo['number_of_channels'] = struct.unpack('<I', block[24:28])[0]
+        streaminfo['sample_rate'] = struct.unpack('<I', block[28:32])[0]  # 2822400 for DSD64
+        streaminfo['bits_per_sample'] = struct.unpack('<I', block[32:36])[0]  # 1 or 8
+        streaminfo['total_samples_in_stream'] = struct.unpack('<Q', block[36:44])[0]  # per channel
+        streaminfo['block_size_per_channel'] = struct.unpack('<I', block[44:48])[0]  # 4096
+        return streaminfo
+
+    def get_audio_offset(self):
+        # first byte of the sample data, past the data chunk header
+        return 28 + struct.unpack('<Q', self.__block_fmt[4:12])[0] + 12
+
+    def get_audio_size(self):
+        # the sample data ends where the tag starts
+        return self.__tag_offset - self.get_audio_offset()
+
+    def get_version(self):
+        # ID3v2 minor version, 3 or 4, new tags are written as 2.3
+        return self.__version
+
+    def get_id3_tags(self):
 
-        (out, err) = proc.communicate()
         id3_tags = dict()
-        if not err:
-            for user_comment in out.splitlines():
-                try:
-                    # retain copyright symbol etc
-                    user_comment = str(user_comment, 'windows-1252')
-                    if '=' in user_comment:
-                        key, value = user_comment.split('=', 1)
-                        # fix the encoding????
-                        key = key.upper().replace("B'", '', 1)
-                        if value:
-                            id3_tags[key] = value
-                except:
-                    pass
-
-        return id3_tags
\ No newline at end of file
+        for _, _, _, key, value in self.__frames:
+            if key and value:
+                id3_tags[key] = value
+        return id3_tags
+
+    def get_id3_block(self):
+        # raw ID3 tag bytes, None when the file has no tag
+        return self.__block_id3_tags
+
+    def set_id3_tags(self, id3_tags):
+        # frames not exposed by get_id3_tags (pictures etc) are untouched,
+        # TXXX:description keys are user defined text frames
+        self.__new_id3_tags = dict(id3_tags)
+
+    def save(self, preserve_modtime=False, atomic=False):
+        # rewrite the trailing ID3 tag, the audio is never moved
+        # atomic copies the file up to the tag to a temp file instead of
+        # truncating in place, so a crash leaves the old or the new file
+        if self.__new_id3_tags is None:
+            return False
+
+        stat = os.stat(self.filename)
+        pending = dict(self.__new_id3_tags)
+        frames = []
+        for frame_id, frame_flags, payload, key, value in self.__frames:
+            if key:
+                if key not in pending:
+                    continue
+                new_value = pending.pop(key)
+                if new_value != value:
+                    frame_id, frame_flags, payload = self.__encode_frame(key, new_value)
+            frames.append((frame_id, frame_flags, payload))
+        for key, value in pending.items():
+            frames.append(self.__encode_frame(key, value))
+
+        out = []
+        for frame_id, frame_flags, payload in frames:
+            if 4 == self.__version:
+                size = _to_syncsafe(len(payload))
+            else:
+                size = struct.pack('>I', len(payload))
+            out += [frame_id, size, frame_flags, payload]
+        body = b''.join(out)
+        tag = b'ID3' + bytes((self.__version, 0, 0)) + _to_syncsafe(len(body)) + body
+
+        pointers = struct.pack('<QQ', self.__tag_offset + len(tag), self.__tag_offset)
+        if atomic:
+            with io.open(self.filename, 'rb') as src, \
+                 atomic_write(self.filename, suffix='.dsf') as dst:
+                dst.write(_read(src, 12) + pointers)
+                dst.flush()
+                copy_range(src, dst, 28, self.__tag_offset - 28)
+                dst.seek(self.__tag_offset)
+                dst.write(tag)
+        else:
+            with io.open(self.filename, 'r+b') as file:
+                file.seek(self.__tag_offset)
+                file.truncate()
+                file.write(tag)
+                file.seek(12)
+                file.write(pointers)
+                file.flush()
+                os.fsync(file.fileno())
+
+        if preserve_modtime:
+            os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        self.__new_id3_tags = None
+        self.__block_id3_tags = None
+        self.__parse()
+        return True
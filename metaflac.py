@@ -2,8 +2,10 @@ import io
 import os
 import struct
 import codecs
-from collections import defaultdict
+import contextlib
+from collections.abc import MutableMapping
 from functools import reduce
+from safewrite import copy_range, atomic_write
 
 # https://xiph.org/flac/format.html#metadata_block
 # All numbers used in a FLAC bitstream are integers; 
@@ -23,53 +25,192 @@ def _read(file, nbytes):  # helper function to check if we haven't reached EOF
     return b
 
 
+class VorbisComment(MutableMapping):
+
+    # key -> list of values over a VORBIS_COMMENT block, values are only
+    # decoded from the block when their key is first read, missing keys
+    # read as a new empty list just like a defaultdict(list)
+
+    __slots__ = ('_block', '_entries')
+
+    def __init__(self, block=b''):
+        self._block = memoryview(block or b'')
+        # decoded keys hold a list, untouched keys a tuple of (start, end)
+        self._entries = dict()
+
+    def add_span(self, key, start, end):
+        spans = self._entries.get(key, ())
+        self._entries[key] = spans + ((start, end),)
+
+    def __decode(self, spans):
+        values = []
+        for start, end in spans:
+            value = str(self._block[start:end], 'UTF-8')
+            if ';' in value:
+                for value in value.split(';'):
+                    value = value.strip()
+                    if value:
+                        values.append(value)
+            else:
+                values.append(value)
+        return values
+
+    def __getitem__(self, key):
+        try:
+            values = self._entries[key]
+        except KeyError:
+            values = self._entries[key] = []
+            return values
+        if type(values) is tuple:
+            values = self._entries[key] = self.__decode(values)
+        return values
+
+    def __setitem__(self, key, values):
+        self._entries[key] = values
+
+    def __delitem__(self, key):
+        del self._entries[key]
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        return self[key] if key in self._entries else default
+
+    def pop(self, key, *default):
+        if key in self._entries:
+            values = self[key]
+            del self._entries[key]
+            return values
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def copy(self):
+        # undecoded spans are shared, decoded lists are copied
+        other = VorbisComment()
+        other._block = self._block
+        other._entries = {key: values if type(values) is tuple else list(values)
+                          for key, values in self._entries.items()}
+        return other
+
+    def __repr__(self):
+        return f'VorbisComment({dict(self.items())!r})'
+
+
 class MetaFlac:
 
-    def __init__(self, filename, ignore_errors=False):
-        self.__block_streaminfo = None
-        self.__block_application = None
-        self.__block_seektable = None
-        self.__block_vorbis_comment = None
-        self.__block_cuesheet = None
-        self.__block_picture = None
+    def __init__(self, filename, ignore_errors=False, fileobj=None):
+        # fileobj, if given, stands in for the file when reading, such as
+        # a prefetched prefetch.HeaderBuffer
+        self.filename = filename
+        self.__fileobj = fileobj
+        self.__parse()
+
+    def __open(self):
+        if self.__fileobj is None:
+            return io.open(self.filename, 'rb')
+        self.__fileobj.seek(0)
+        return contextlib.nullcontext(self.__fileobj)
+
+    def __parse(self):
         self.__ID3_tags = False
+        self.__new_vorbis_comment = None
+        # offsets of blocks to drop and (type, payload) of blocks to add
+        self.__removed_blocks = set()
+        self.__added_blocks = []
+        # (block_type, offset, size) of every metadata block, in file order,
+        # payloads are only read when asked for
+        self.__blocks = []
+        self.__payloads = dict()
 
-        with io.open(filename, 'rb') as file:
+        with self.__open() as file:
 
             # deal with ID3 too
             self.__parse_marker(file)
+            self.__metadata_start = file.tell()
 
             last = 0
             while not last:
-                last, block_type, size = self.__parse_block_header(file.read(4))
+                offset = file.tell()
+                last, block_type, size = self.__parse_block_header(_read(file, 4))
 
-                if block_type == 0:
-                    self.__block_streaminfo = file.read(size)
+                if block_type == 127:
+                    raise NotImplementedError('invalid, to avoid confusion with a frame sync code')
 
-                elif block_type == 1:
-                    file.read(size)
+                elif block_type > 6:
+                    print(block_type)
+                    raise NotImplementedError('reserved')
 
-                elif block_type == 2:
-                    self.__block_application = file.read(size)
+                self.__blocks.append((block_type, offset, size))
+                file.seek(size, os.SEEK_CUR)
 
-                elif block_type == 3:
-                    self.__block_seektable = file.read(size)
+            # first byte of the first audio frame
+            self.__audio_offset = file.tell()
 
-                elif block_type == 4:
-                    self.__block_vorbis_comment = file.read(size)
+    def __payload(self, block_type):
+        # the last block of a type wins, as it did when every block was read
+        found = None
+        for entry in self.__blocks:
+            if entry[0] == block_type:
+                found = entry
+        if not found:
+            return None
+        _, offset, size = found
+        if offset not in self.__payloads:
+            with self.__open() as file:
+                file.seek(offset + 4)
+                self.__payloads[offset] = _read(file, size)
+        return self.__payloads[offset]
 
-                elif block_type == 5:
-                    self.__block_cuesheet = file.read(size)
+    @property
+    def __block_streaminfo(self):
+        return self.__payload(0)
 
-                elif block_type == 6:
-                    self.__block_picture = file.read(size)
+    @property
+    def __block_application(self):
+        return self.__payload(2)
 
-                elif block_type < 127:
-                    print(block_type)
-                    raise NotImplementedError('reserved')
+    @property
+    def __block_seektable(self):
+        return self.__payload(3)
 
-                else:
-                    raise NotImplementedError('invalid, to avoid confusion with a frame sync code')
+    @property
+    def __block_vorbis_comment(self):
+        return self.__payload(4)
+
+    @property
+    def __block_cuesheet(self):
+        return self.__payload(5)
+
+    @property
+    def __block_picture(self):
+        return self.__payload(6)
+
+    def get_blocks(self):
+        # (block_type, offset, size) index of the metadata blocks
+        return list(self.__blocks)
+
+    def get_block(self, block_type):
+        # raw payload of a metadata block, None when absent
+        return self.__payload(block_type)
+
+    def has_id3_tags(self):
+        return self.__ID3_tags
+
+    def get_audio_offset(self):
+        # first byte of the first audio frame, just past the last block
+        return self.__audio_offset
+
+    def get_audio_size(self):
+        # the frames run to the end of the file
+        return os.path.getsize(self.filename) - self.__audio_offset
 
     def __parse_marker(self, file):
         # check for ID3 - rare but annoying
@@ -105,8 +246,8 @@ class MetaFlac:
         block = self.__block_streaminfo
         streaminfo['minimum_blockSize'] = struct.unpack('>H', block[0:2])[0] # 16bits The minimum block size (in samples) used in the stream.
         streaminfo['maximum_blockSize'] = struct.unpack('>H', block[2:4])[0] # 16bits The maximum block size (in samples) used in the stream.
-        streaminfo['minimum_frameSize'] = struct.unpack('>I', '\x00' + block[4:7])[0] # 24bits The minimum frame size (in bytes) used in the stream.
-        streaminfo['maximum_frameSize'] = struct.unpack('>I', '\x00' + block[7:10])[0] # 24bits The maximum frame size (in bytes) used in the stream.
+        streaminfo['minimum_frameSize'] = struct.unpack('>I', b'\x00' + block[4:7])[0] # 24bits The minimum frame size (in bytes) used in the stream.
+        streaminfo['maximum_frameSize'] = struct.unpack('>I', b'\x00' + block[7:10])[0] # 24bits The maximum frame size (in bytes) used in the stream.
         unpacked = struct.unpack('>Q', block[10:18])[0]
         streaminfo['total_samples_in_stream'] = unpacked & 0xfffffffff # (36bits) Total samples in stream.
         unpacked = unpacked >> 36
@@ -130,14 +271,12 @@ class MetaFlac:
     def get_seektable(self):
         if not self.__block_seektable:
             return None
-        seektable = list()
-        for i in xrange(0, len(self.__block_seektable), 18):
-            number = struct.unpack('>Q', self.__block_seektable[i:i+8])[0] # (64bits) Sample number of first sample in the target frame, or 0xFFFFFFFFFFFFFFFF for a placeholder point.
-            offset = struct.unpack('>Q', self.__block_seektable[i+8:i+16])[0] # (64bits) Offset (in bytes) from the first byte of the first frame header to the first byte of the target frame's header.
-            samples = struct.unpack('>H', self.__block_seektable[i+16:i+18])[0] # (16bits) Number of samples in the target frame.
-            seekpoint = (number, offset, samples)
-            seektable.append(seekpoint)
-        return seektable
+        # every seekpoint in one pass, (number, offset, samples)
+        # number  (64bits) Sample number of first sample in the target frame, or 0xFFFFFFFFFFFFFFFF for a placeholder point.
+        # offset  (64bits) Offset (in bytes) from the first byte of the first frame header to the first byte of the target frame's header.
+        # samples (16bits) Number of samples in the target frame.
+        block = self.__block_seektable
+        return list(struct.iter_unpack('>QQH', block[:len(block) - len(block) % 18]))
 
     def get_picture(self):
         if not self.__block_picture:
@@ -159,38 +298,224 @@ class MetaFlac:
         picture['data'] = block[20:20+length] # (n*8bites) The binary picture data.
         return picture
 
+    def get_picture_blocks(self):
+        # every PICTURE block without reading the picture data, each as
+        # the get_picture fields plus offset (of the block header) and
+        # data_offset/data_length to stream the data from
+        pictures = []
+        with self.__open() as file:
+            for block_type, offset, size in self.__blocks:
+                if block_type != 6:
+                    continue
+                file.seek(offset + 4)
+                picture = dict(offset=offset)
+                picture['picture_type'], length = struct.unpack('>II', _read(file, 8))
+                picture['mime'] = _read(file, length)
+                length = struct.unpack('>I', _read(file, 4))[0]
+                picture['description'] = codecs.decode(_read(file, length), 'UTF-8')
+                picture['width'], picture['height'], picture['depth'], \
+                    picture['nOfcolors'], picture['data_length'] = struct.unpack('>5I', _read(file, 20))
+                picture['data_offset'] = file.tell()
+                pictures.append(picture)
+        return pictures
+
+    def remove_block(self, offset):
+        # drop the block at offset (from get_blocks) on the next save
+        self.__removed_blocks.add(offset)
+
+    def add_block(self, block_type, payload):
+        # append a block on the next save
+        if len(payload) > 0xffffff:
+            raise MetaFlacException(f'block too large on {self.filename}')
+        self.__added_blocks.append((block_type, payload))
+
+    def __comment_entries(self, block):
+        # (start, equals, end) of each KEY=value entry, walked by offset
+        vendorLength = struct.unpack_from('<I', block, 0)[0] # (32bits) vendor_length
+        pos = 4 + vendorLength
+        userCommentListLength = struct.unpack_from('<I', block, pos)[0] # (32bits) user_comment_list_length
+        pos += 4
+        for i in range(userCommentListLength):
+            length = struct.unpack_from('<I', block, pos)[0]
+            start = pos + 4
+            pos = start + length
+            if pos > len(block):
+                raise MetaFlacException(f'truncated vorbis comment on {self.filename}')
+            equals = block.find(b'=', start, pos)
+            if equals >= 0:
+                yield start, equals, pos
+
     def get_vorbis_comment(self):
         # https://www.xiph.org/vorbis/doc/v-comment.html
         # note that the 32-bit field lengths are little-endian coded according to the vorbis spec, as opposed to the usual big-endian coding of fixed-length integers in the rest of FLAC.
-        if not self.__block_vorbis_comment:
-            return None
-        # support multiple entries for genre, artist etc
-        vorbis_comment = defaultdict(list)
         block = self.__block_vorbis_comment
-        vendorLength = struct.unpack('I', block[0:4])[0] # (32bits) vendor_length
-        vendor = codecs.decode(block[4:4+vendorLength], 'UTF-8') 
-        block = block[4+vendorLength:]
-        userCommentListLength = struct.unpack('I', block[0:4])[0] # (32bits) user_comment_list_length
-        block = block[4:]
+        # support multiple entries for genre, artist etc
+        vorbis_comment = VorbisComment(block)
+        if not block:
+            return vorbis_comment, False, self.__ID3_tags
+        # keys are decoded now and values when read
         expanded = False
-        for i in range(userCommentListLength):
-            length = struct.unpack('I', block[0:4])[0]
-            user_comment = codecs.decode(block[4:4+length], 'UTF-8')
-            block = block[4+length:]
-            if '=' in user_comment:
-                key, value = user_comment.split('=', 1)
-                key = key.upper()
-                # support multiple entries for genre, artist etc
-                if ';' in value:
-                    for value in value.split(';'):
-                        expanded = True
-                        value = value.strip()
-                        if value:
-                            vorbis_comment[key].append(value)
-                else:
-                    vorbis_comment[key].append(value)
+        for start, equals, end in self.__comment_entries(block):
+            key = codecs.decode(block[start:equals], 'UTF-8').upper()
+            # support multiple entries for genre, artist etc
+            if block.find(b';', equals, end) >= 0:
+                expanded = True
+            vorbis_comment.add_span(key, equals + 1, end)
         return vorbis_comment, expanded, self.__ID3_tags
 
+    def get_comment_entries(self):
+        # [(key, value)] exactly as stored, key case kept and values not
+        # split on ';'
+        block = self.__block_vorbis_comment
+        if not block:
+            return []
+        return [(codecs.decode(block[start:equals], 'UTF-8'),
+                 codecs.decode(block[equals + 1:end], 'UTF-8'))
+                for start, equals, end in self.__comment_entries(block)]
+
+    def get_vendor(self):
+        if not self.__block_vorbis_comment:
+            return 'fixflactag'
+        block = self.__block_vorbis_comment
+        vendorLength = struct.unpack_from('<I', block, 0)[0]
+        return codecs.decode(block[4:4+vendorLength], 'UTF-8')
+
+    def set_vorbis_comment(self, comment, vendor=None):
+        # comment is either a mapping of key to a list of values, as
+        # returned by get_vorbis_comment, or an iterable of (key, value)
+        if hasattr(comment, 'items'):
+            comment = [(k, v) for k, values in comment.items() for v in values]
+        if vendor is None:
+            vendor = self.get_vendor()
+        vendor = vendor.encode('UTF-8')
+        block = [struct.pack('<I', len(vendor)), vendor,
+                 struct.pack('<I', len(comment))]
+        for key, value in comment:
+            user_comment = f'{key}={value}'.encode('UTF-8')
+            block.append(struct.pack('<I', len(user_comment)))
+            block.append(user_comment)
+        block = b''.join(block)
+        if len(block) > 0xffffff:
+            raise MetaFlacException(f'vorbis comment too large on {self.filename}')
+        self.__new_vorbis_comment = block
+
+    def save(self, padding=8192, preserve_modtime=True, strip_id3=False,
+             max_padding=None, atomic=False):
+        # write the pending vorbis comment back, in place when the old
+        # comment plus the padding block can hold it, otherwise stream a
+        # rewrite of the whole file leaving padding bytes of new padding
+        # strip_id3 drops a leading ID3 tag in that same single rewrite
+        # max_padding caps the padding an in-place write may leave, e.g.
+        # when dropping a picture should give the space back
+        # atomic never writes in place, the file is always replaced by a
+        # fsynced rewrite so a crash leaves either the old or the new file
+        strip_id3 = strip_id3 and self.__ID3_tags
+        if self.__new_vorbis_comment is None and not strip_id3 and \
+           not self.__removed_blocks and not self.__added_blocks:
+            return False
+
+        stat = os.stat(self.filename)
+
+        # new layout: the existing blocks in order with the comment swapped,
+        # padding dropped and a single padding block appended at the end
+        layout = []
+        for block_type, offset, size in self.__blocks:
+            if block_type == 4 and self.__new_vorbis_comment is not None:
+                layout.append((4, None, self.__new_vorbis_comment))
+            elif block_type != 1 and offset not in self.__removed_blocks:
+                layout.append((block_type, offset, size))
+        if self.__new_vorbis_comment is not None and \
+           not any(block_type == 4 for block_type, _, _ in layout):
+            layout.insert(1, (4, None, self.__new_vorbis_comment))
+        layout += [(block_type, None, payload)
+                   for block_type, payload in self.__added_blocks]
+
+        # blocks already sitting at their final position are left alone
+        pos = self.__metadata_start
+        keep = 0
+        for block_type, offset, size in layout:
+            if offset != pos:
+                break
+            pos += 4 + size
+            keep += 1
+
+        with io.open(self.filename, 'rb') as file:
+            tail = []
+            for block_type, offset, payload in layout[keep:]:
+                if offset is not None:
+                    file.seek(offset + 4)
+                    payload = _read(file, payload)
+                tail.append((block_type, payload))
+
+        needed = sum(4 + len(payload) for _, payload in tail)
+        available = self.__audio_offset - pos
+        if strip_id3 or atomic:
+            # the whole stream moves up, so it can only be a rewrite
+            in_place = False
+        elif needed == available:
+            in_place = True
+            spare = None
+        elif needed + 4 <= available and \
+             (max_padding is None or available - needed - 4 <= max_padding):
+            in_place = True
+            spare = available - needed - 4
+        else:
+            in_place = False
+
+        if in_place:
+            if spare is not None:
+                tail.append((1, bytes(spare)))
+            with io.open(self.filename, 'r+b') as file:
+                if keep:
+                    # the last kept block may have carried the last flag
+                    block_type, offset, size = layout[keep - 1]
+                    file.seek(offset)
+                    file.write(self.__block_header(False, block_type, size))
+                file.seek(pos)
+                file.write(self.__pack_blocks(tail))
+                file.flush()
+                os.fsync(file.fileno())
+        else:
+            self.__rewrite(layout[:keep], tail, padding, strip_id3)
+
+        if preserve_modtime:
+            os.utime(self.filename, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        # anything prefetched is stale now
+        self.__fileobj = None
+        self.__parse()
+        return True
+
+    def __rewrite(self, head, tail, padding, strip_id3=False):
+        if padding:
+            tail = tail + [(1, bytes(padding))]
+        with io.open(self.filename, 'rb') as src, \
+             atomic_write(self.filename, suffix='.flac') as dst:
+            if strip_id3:
+                dst.write(b'fLaC')
+            else:
+                # anything before the marker (ID3) is carried over as is
+                dst.write(_read(src, self.__metadata_start))
+            blocks = []
+            for block_type, offset, size in head:
+                src.seek(offset + 4)
+                blocks.append((block_type, _read(src, size)))
+            dst.write(self.__pack_blocks(blocks + tail))
+            dst.flush()
+            # the audio frames never pass through user space
+            size = os.fstat(src.fileno()).st_size - self.__audio_offset
+            copy_range(src, dst, self.__audio_offset, size)
+
+    def __pack_blocks(self, blocks):
+        out = []
+        for idx, (block_type, payload) in enumerate(blocks):
+            out.append(self.__block_header(idx == len(blocks) - 1, block_type, len(payload)))
+            out.append(payload)
+        return b''.join(out)
+
+    def __block_header(self, last, block_type, size):
+        return struct.pack('>I', (int(last) << 31) | (block_type << 24) | size)
+
     def _calc_size(self, bytestr, bits_per_byte):
         # length of some mp3 header fields is described by 7 or 8-bit-bytes
         return reduce(lambda accu, elem: (accu << bits_per_byte) + elem, bytestr, 0)
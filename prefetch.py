@@ -0,0 +1,149 @@
+import io
+import os
+import struct
+import bisect
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# header prefetch for high latency mounts (NFS/SMB)
+# many files have their first size bytes read at once by a thread pool,
+# a second read is only issued for a file whose metadata runs past that,
+# and the parser is then handed a HeaderBuffer that answers from memory
+
+
+class HeaderBuffer:
+
+    # read-only, seekable stand in for a file built from prefetched
+    # extents, reads outside them fall through to the real file
+
+    def __init__(self, filename, extents):
+        self.filename = filename
+        self.__starts = []
+        self.__extents = []
+        for start, data in sorted(extents.items()):
+            self.__starts.append(start)
+            self.__extents.append(data)
+        self.__pos = 0
+        self.misses = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def close(self):
+        pass
+
+    def tell(self):
+        return self.__pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.__pos
+        elif whence != os.SEEK_SET:
+            raise io.UnsupportedOperation('only SEEK_SET and SEEK_CUR')
+        self.__pos = offset
+        return offset
+
+    def read(self, size=-1):
+        out = []
+        while size != 0:
+            idx = bisect.bisect_right(self.__starts, self.__pos) - 1
+            if idx >= 0:
+                start, data = self.__starts[idx], self.__extents[idx]
+                if self.__pos < start + len(data):
+                    end = len(data) if size < 0 else min(len(data), self.__pos - start + size)
+                    chunk = data[self.__pos - start:end]
+                    out.append(chunk)
+                    self.__pos += len(chunk)
+                    size = size - len(chunk) if size > 0 else size
+                    continue
+            # not prefetched, go to the file for the rest
+            self.misses += 1
+            with io.open(self.filename, 'rb') as file:
+                file.seek(self.__pos)
+                chunk = file.read(size)
+            out.append(chunk)
+            self.__pos += len(chunk)
+            break
+        return b''.join(out)
+
+
+def read_header(filename, size=65536, opener=io.open):
+    # every FLAC block header plus the small payloads the fixes need,
+    # pictures and other large payloads are seeked past unread
+    extents = dict()
+    with opener(filename, 'rb') as file:
+        data = file.read(size)
+        extents[0] = data
+        if not filename.lower().endswith('.flac'):
+            return HeaderBuffer(filename, extents)
+
+        def covered(offset, length):
+            for start, extent in extents.items():
+                if start <= offset and offset + length <= start + len(extent):
+                    return True
+            return False
+
+        def ensure(offset, length):
+            # one more round trip, at least size bytes
+            if not covered(offset, length):
+                file.seek(offset)
+                extents[offset] = file.read(max(length, size))
+                return len(extents[offset]) >= length
+            return True
+
+        pos = 0
+        if data[:3] == b'ID3' and len(data) >= 10:
+            tag_size = data[6:10]
+            pos = 10 + ((tag_size[0] << 21) | (tag_size[1] << 14) | (tag_size[2] << 7) | tag_size[3])
+        if not ensure(pos, 4):
+            return HeaderBuffer(filename, extents)
+        pos += 4
+
+        last = 0
+        while not last:
+            if not ensure(pos, 4):
+                break
+            header = HeaderBuffer(filename, extents)
+            header.seek(pos)
+            unpacked = struct.unpack('>I', header.read(4))[0]
+            last = unpacked >> 31
+            block_type = unpacked >> 24 & 0x7f
+            length = unpacked & 0x00ffffff
+            if block_type in (0, 3, 4):
+                # streaminfo, seektable and the comment are wanted
+                if not ensure(pos + 4, length):
+                    break
+            pos += 4 + length
+    return HeaderBuffer(filename, extents)
+
+
+def prefetch_headers(paths, size=65536, threads=16, opener=io.open):
+    # yields (path, HeaderBuffer or the exception) in path order with at
+    # most a few batches of reads in flight, non-FLAC paths are passed
+    # through with None and never opened here
+    window = 4 * threads
+    with ThreadPoolExecutor(threads) as pool:
+        pending = deque()
+
+        def drain():
+            path, future = pending.popleft()
+            if future is None:
+                return path, None
+            try:
+                return path, future.result()
+            except Exception as err:
+                return path, err
+
+        for path in paths:
+            path = str(path)
+            if path.lower().endswith('.flac'):
+                pending.append((path, pool.submit(read_header, path, size, opener)))
+            else:
+                pending.append((path, None))
+            if len(pending) >= window:
+                yield drain()
+        while pending:
+            yield drain()
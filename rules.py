@@ -0,0 +1,117 @@
+import re
+import logging
+import time
+from collections import namedtuple, defaultdict
+
+logger = logging.getLogger('fixflactag.rules')
+
+# declarative comment cleanup rules
+# field   - tag the rule looks at, only its first value is matched
+# pattern - regex searched for in that value, None matches any value
+# actions - 'drop' removes the field, 'replaygain' adds the vinyl
+#           replaygain bump when the track has no gain yet
+
+Rule = namedtuple('Rule', 'name field pattern actions')
+
+DEFAULT_COMMENT = r'ffz|FFZ|fzz|FZZ|\A\s*\Z'
+VINYL_COMMENT = r'inyl|Digitally'
+
+RULES = (
+    Rule('default-comment', 'COMMENT', DEFAULT_COMMENT, ('drop',)),
+    Rule('default-comments', 'COMMENTS', DEFAULT_COMMENT, ('drop',)),
+    Rule('vinyl-comment', 'COMMENT', VINYL_COMMENT, ('replaygain', 'drop')),
+    Rule('vinyl-comments', 'COMMENTS', VINYL_COMMENT, ('replaygain', 'drop')),
+    Rule('nad-comment', 'COMMENT', r'NAD', ('replaygain',)),
+    Rule('nad-comments', 'COMMENTS', r'NAD', ('replaygain', 'drop')),
+    Rule('vinyl-rip-album', 'ALBUM', r'24bVR', ('replaygain',)),
+    Rule('vinylstudio-contact', 'CONTACT', r'\AVinylStudio\Z', ('replaygain',)),
+    # redundant tags
+    Rule('redundant-contact', 'CONTACT', None, ('drop',)),
+    Rule('redundant-location', 'LOCATION', None, ('drop',)),
+    Rule('redundant-grouping', 'GROUPING', None, ('drop',)),
+    Rule('redundant-media', 'MEDIA', None, ('drop',)),
+    Rule('redundant-description', 'DESCRIPTION', None, ('drop',)),
+    Rule('redundant-discogs', 'URL_DISCOGS_RELEASE_SITE', None, ('drop',)),
+)
+
+
+class RuleSet:
+
+    # rules compiled to one regex alternation per field, evaluated in a
+    # single pass over the comment dict
+
+    def __init__(self, rules=RULES):
+        self.rules = tuple(rules)
+        self.__fields = dict()
+        by_field = defaultdict(list)
+        for idx, rule in enumerate(self.rules):
+            by_field[rule.field].append((f'r{idx}', rule))
+        for field, named in by_field.items():
+            always = tuple(rule for _, rule in named if rule.pattern is None)
+            alternation = '|'.join(f'(?P<{group}>{rule.pattern})'
+                                   for group, rule in named
+                                   if rule.pattern is not None)
+            regex = re.compile(alternation) if alternation else None
+            groups = {group: rule for group, rule in named}
+            self.__fields[field] = (regex, groups, always)
+        self.reset_stats()
+
+    def reset_stats(self):
+        # rule name -> hits, field -> seconds spent matching and acting
+        self.hits = dict.fromkeys((rule.name for rule in self.rules), 0)
+        self.seconds = dict.fromkeys(self.__fields, 0.0)
+
+    def take_stats(self):
+        stats = dict(hits=self.hits, seconds=self.seconds)
+        self.reset_stats()
+        return stats
+
+    def merge_stats(self, stats):
+        for name, hits in stats['hits'].items():
+            self.hits[name] = self.hits.get(name, 0) + hits
+        for field, seconds in stats['seconds'].items():
+            self.seconds[field] = self.seconds.get(field, 0.0) + seconds
+
+    def report(self):
+        # a field's rules are matched by one regex, so time is only known
+        # per field, hits per rule
+        for rule in self.rules:
+            logger.info(f'Rule {rule.name:<24} {rule.field:<26} '
+                        f'hits {self.hits[rule.name]:>8}')
+        for field, seconds in sorted(self.seconds.items()):
+            logger.info(f'Field {field:<26} rules time {seconds:.6f}s')
+
+    def apply(self, comment, replay_gain):
+        # returns True when the comment was changed
+        drop = set()
+        replaygain = False
+        for field in list(comment):
+            compiled = self.__fields.get(field)
+            if not compiled:
+                continue
+            # only fields with rules get their values decoded
+            values = comment[field]
+            if not values:
+                continue
+            start = time.perf_counter()
+            regex, groups, hit = compiled
+            if regex:
+                matched = {match.lastgroup for match in regex.finditer(values[0])}
+                hit = hit + tuple(groups[group] for group in sorted(matched))
+            for rule in hit:
+                self.hits[rule.name] += 1
+                if 'drop' in rule.actions:
+                    drop.add(field)
+                if 'replaygain' in rule.actions:
+                    replaygain = True
+            self.seconds[field] += time.perf_counter() - start
+
+        changed = bool(drop)
+        if replaygain and 'REPLAYGAIN_TRACK_GAIN' not in comment:
+            comment['REPLAYGAIN_TRACK_GAIN'] = [replay_gain]
+            logger.debug('Add REPLAYGAIN_TRACK_GAIN Tag')
+            changed = True
+        for field in sorted(drop):
+            comment.pop(field, None)
+            logger.debug(f'Delete {field} Tag')
+        return changed
@@ -0,0 +1,117 @@
+import io
+import os
+import errno
+import shutil
+import tempfile
+import contextlib
+
+# crash safe file replacement, new content goes to a temp file next to
+# the target which is fsynced and renamed over it, the directory is then
+# fsynced so the rename itself survives a power cut
+# temp files are named .fixflactag-<pid>-*, leftovers of a dead process
+# are recognised by that pid and removed
+
+TEMP_PREFIX = '.fixflactag-'
+
+
+def copy_range(src, dst, offset, count):
+    # copy count bytes from offset in src to the current end of dst,
+    # kernel side where the platform allows it
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    dst_pos = os.lseek(dst_fd, 0, os.SEEK_CUR)
+    try:
+        while count > 0:
+            if hasattr(os, 'copy_file_range'):
+                copied = os.copy_file_range(src_fd, dst_fd, count, offset, dst_pos)
+            else:
+                os.lseek(dst_fd, dst_pos, os.SEEK_SET)
+                copied = os.sendfile(dst_fd, src_fd, offset, count)
+            if copied == 0:
+                raise EOFError('Unexpected end of file')
+            offset += copied
+            dst_pos += copied
+            count -= copied
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+        # cross device or unsupported filesystem, copy the rest in user space
+        src.seek(offset)
+        os.lseek(dst_fd, dst_pos, os.SEEK_SET)
+        while count > 0:
+            chunk = src.read(min(count, 1 << 20))
+            if not chunk:
+                raise EOFError('Unexpected end of file')
+            os.write(dst_fd, chunk)
+            count -= len(chunk)
+    else:
+        os.lseek(dst_fd, dst_pos, os.SEEK_SET)
+
+
+def fsync_dir(folder):
+    # not every platform can open a directory
+    with contextlib.suppress(OSError):
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def temp_prefix():
+    return f'{TEMP_PREFIX}{os.getpid()}-'
+
+
+@contextlib.contextmanager
+def atomic_write(filename, like=None, suffix='.tmp'):
+    # yields a binary file that replaces filename once the block exits
+    # cleanly, with the mode and owner of like (default filename itself,
+    # if any)
+    folder = os.path.dirname(os.path.abspath(filename))
+    fd, temp_name = tempfile.mkstemp(suffix=suffix, prefix=temp_prefix(), dir=folder)
+    try:
+        with io.open(fd, 'wb') as out:
+            yield out
+            out.flush()
+            os.fsync(out.fileno())
+        like = like or filename
+        if os.path.exists(like):
+            shutil.copymode(like, temp_name)
+            # keep the owner too, as metaflac does, a root run over a
+            # shared library must not hand files to root
+            stat = os.stat(like)
+            with contextlib.suppress(PermissionError):
+                os.chown(temp_name, stat.st_uid, stat.st_gid)
+        os.replace(temp_name, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_name)
+        raise
+    fsync_dir(folder)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_stale_temps(folder, prefix=TEMP_PREFIX):
+    # temp files left by processes that are gone, returns how many
+    removed = 0
+    try:
+        with os.scandir(folder) as it:
+            names = [entry.name for entry in it if entry.name.startswith(prefix)]
+    except OSError:
+        return 0
+    for name in names:
+        pid = name[len(prefix):].split('-', 1)[0]
+        if not pid.isdigit() or _alive(int(pid)):
+            continue
+        with contextlib.suppress(OSError):
+            os.unlink(os.path.join(folder, name))
+            removed += 1
+    return removed
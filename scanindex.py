@@ -0,0 +1,86 @@
+import os
+import sqlite3
+import hashlib
+from metaflac import MetaFlac
+from metadsf import MetaDsf
+
+# persistent record of files already processed, keyed by path
+# a file is provably clean when its inode, size and ctime are unchanged
+# since it was last processed under the same rules, or failing that
+# when the digest of its tag block is unchanged
+
+
+def tag_digest(filename, fileobj=None, metaflac=None):
+    # digest over the bytes the fixes act on, header reads only
+    digest = hashlib.blake2b(digest_size=16)
+    if filename.lower().endswith('.flac'):
+        if metaflac is None:
+            metaflac = MetaFlac(filename, fileobj=fileobj)
+        digest.update(b'ID3' if metaflac.has_id3_tags() else b'fLaC')
+        digest.update(metaflac.get_block(4) or b'')
+    elif filename.lower().endswith('.dsf'):
+        digest.update(MetaDsf(filename).get_id3_block() or b'')
+    else:
+        return None
+    return digest.hexdigest()
+
+
+def stat_key(filename):
+    st = os.stat(filename)
+    return st.st_ino, st.st_size, st.st_ctime_ns
+
+
+class ScanIndex:
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.__pending = 0
+        self.__db = sqlite3.connect(filename)
+        self.__db.execute('''CREATE TABLE IF NOT EXISTS files (
+                                 path TEXT PRIMARY KEY,
+                                 inode INTEGER,
+                                 size INTEGER,
+                                 ctime INTEGER,
+                                 digest TEXT,
+                                 rules TEXT)''')
+        self.__db.commit()
+
+    def lookup(self, path):
+        # (inode, size, ctime, digest, rules) or None
+        return self.__db.execute('SELECT inode, size, ctime, digest, rules '
+                                 'FROM files WHERE path = ?',
+                                 (path,)).fetchone()
+
+    def check(self, path, rules):
+        # returns (clean, known_digest), known_digest lets the caller
+        # skip a file whose stat changed but whose tags did not
+        row = self.lookup(path)
+        if row is None or row[4] != rules:
+            return False, None
+        try:
+            if tuple(row[:3]) == stat_key(path):
+                return True, row[3]
+        except OSError:
+            return False, None
+        return False, row[3]
+
+    def record(self, path, key, digest, rules):
+        self.__db.execute('INSERT OR REPLACE INTO files '
+                          '(path, inode, size, ctime, digest, rules) '
+                          'VALUES (?, ?, ?, ?, ?, ?)',
+                          (path,) + tuple(key) + (digest, rules))
+        self.__pending += 1
+        if self.__pending >= 1000:
+            self.commit()
+
+    def forget(self, path):
+        self.__db.execute('DELETE FROM files WHERE path = ?', (path,))
+        self.__pending += 1
+
+    def commit(self):
+        self.__db.commit()
+        self.__pending = 0
+
+    def close(self):
+        self.commit()
+        self.__db.close()
@@ -0,0 +1,135 @@
+import os
+import time
+import json
+import contextlib
+from collections import Counter, defaultdict
+
+# per stage timings and run counters
+# each process keeps its own Stats, workers hand theirs back with every
+# result and the parent merges them, the report has p50/p95/p99 per
+# stage and is written as JSON and/or a Prometheus textfile
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def bytes_read():
+    # rchar counts every byte read through read(2), cached or not
+    try:
+        with open('/proc/self/io') as io_stats:
+            for line in io_stats:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def quantile(ordered, q):
+    # nearest rank on already sorted samples
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(q * len(ordered) + 0.5) - 1))]
+
+
+class Stats:
+
+    def __init__(self):
+        self.reset_stats()
+
+    def reset_stats(self):
+        # stage -> seconds per call, counter name -> total
+        self.samples = defaultdict(list)
+        self.counters = Counter()
+
+    def take_stats(self):
+        stats = dict(samples=dict(self.samples), counters=dict(self.counters))
+        self.reset_stats()
+        return stats
+
+    def merge_stats(self, stats):
+        for stage, samples in stats['samples'].items():
+            self.samples[stage].extend(samples)
+        self.counters.update(stats['counters'])
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples[stage].append(time.perf_counter() - start)
+
+    def timed(self, stage, iterable):
+        # times each step of an iterator, e.g. the directory walk
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.samples[stage].append(time.perf_counter() - start)
+                return
+            self.samples[stage].append(time.perf_counter() - start)
+            yield item
+
+    def report(self, summary, seconds):
+        stages = dict()
+        for stage, samples in sorted(self.samples.items()):
+            ordered = sorted(samples)
+            stages[stage] = dict(count=len(ordered),
+                                 seconds=sum(ordered),
+                                 max=ordered[-1] if ordered else 0.0,
+                                 **{f'p{round(q * 100)}': quantile(ordered, q)
+                                    for q in QUANTILES})
+        files = summary['scanned']
+        return dict(timestamp=time.time(),
+                    seconds=seconds,
+                    files_per_second=files / seconds if seconds else 0.0,
+                    files=dict(summary),
+                    counters=dict(self.counters),
+                    stages=stages)
+
+
+def write_json(report, filename):
+    if '-' == filename:
+        print(json.dumps(report, indent=2))
+        return
+    with open(filename, 'w') as out:
+        json.dump(report, out, indent=2)
+        out.write('\n')
+
+
+def prometheus_text(report, prefix='fixflactag'):
+    lines = [f'# HELP {prefix}_files Files by outcome in the last run',
+             f'# TYPE {prefix}_files gauge']
+    for outcome, files in sorted(report['files'].items()):
+        lines.append(f'{prefix}_files{{outcome="{outcome}"}} {files}')
+    for name, value in sorted(report['counters'].items()):
+        lines += [f'# TYPE {prefix}_{name} gauge',
+                  f'{prefix}_{name} {value}']
+    lines += [f'# TYPE {prefix}_run_seconds gauge',
+              f'{prefix}_run_seconds {report["seconds"]:.6f}',
+              f'# TYPE {prefix}_files_per_second gauge',
+              f'{prefix}_files_per_second {report["files_per_second"]:.3f}',
+              f'# TYPE {prefix}_last_run_timestamp_seconds gauge',
+              f'{prefix}_last_run_timestamp_seconds {report["timestamp"]:.0f}',
+              f'# HELP {prefix}_stage_seconds Seconds per call of each stage',
+              f'# TYPE {prefix}_stage_seconds summary']
+    for stage, timing in report['stages'].items():
+        for q in QUANTILES:
+            lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="{q}"}} '
+                         f'{timing[f"p{round(q * 100)}"]:.6f}')
+        lines += [f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {timing["seconds"]:.6f}',
+                  f'{prefix}_stage_seconds_count{{stage="{stage}"}} {timing["count"]}']
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus(report, filename):
+    # textfile collectors may read at any time, so write then rename
+    temp_name = f'{filename}.{os.getpid()}.tmp'
+    with open(temp_name, 'w') as out:
+        out.write(prometheus_text(report))
+    os.replace(temp_name, filename)
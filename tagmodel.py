@@ -0,0 +1,184 @@
+import logging
+from metaflac import MetaFlac, VorbisComment
+from metadsf import MetaDsf
+
+logger = logging.getLogger('fixflactag.tagmodel')
+
+# one tag model for every format, Vorbis comment style: upper case keys
+# each with a list of values, as MetaFlac.get_vorbis_comment returns them
+# a handler per format reads a file into the model and writes it back,
+# the cleanup rules only ever see the model
+# handler interface
+#   format, suffixes
+#   meta                            the format's parser, parsed once
+#   read() -> (comment, changed, strip_id3)
+#   stored() -> (tags, recased)     the tags as the file holds them, for
+#                                   what a plan changes, recased are keys
+#                                   stored in another case
+#   fixes(comment) -> changed       format specific cleanup
+#   write(pairs, padding, strip_id3, atomic)
+# a new format is a handler plus an entry in HANDLERS
+
+
+class FlacHandler:
+
+    format = 'flac'
+    suffixes = ('.flac',)
+
+    def __init__(self, filename, meta=None, fileobj=None):
+        self.filename = filename
+        self.meta = meta if meta is not None else MetaFlac(filename, fileobj=fileobj)
+
+    def read(self):
+        return self.meta.get_vorbis_comment()
+
+    def stored(self):
+        # values not split on ';', so a split shows as a rewrite
+        tags = dict()
+        recased = set()
+        for key, value in self.meta.get_comment_entries():
+            tags.setdefault(key.upper(), []).append(value)
+            if key != key.upper():
+                recased.add(key.upper())
+        return tags, recased
+
+    def fixes(self, comment):
+        return False
+
+    def write(self, pairs, padding=8192, strip_id3=False, atomic=False):
+        self.meta.set_vorbis_comment(pairs)
+        # any ID3 tag goes in the same single rewrite
+        self.meta.save(padding=padding, strip_id3=strip_id3, atomic=atomic)
+
+
+# ID3 frame -> model key, the first frame listed for a key is the one
+# written for 2.4 tags, the second for 2.3 where they differ
+ID3_KEYS = (('TIT2', 'TITLE'),
+            ('TPE1', 'ARTIST'),
+            ('TPE2', 'ALBUMARTIST'),
+            ('TALB', 'ALBUM'),
+            ('TCON', 'GENRE'),
+            ('TDRC', 'DATE'),
+            ('TYER', 'DATE'),
+            ('TDOR', 'ORIGINALDATE'),
+            ('TORY', 'ORIGINALDATE'),
+            ('TIT1', 'GROUPING'),
+            ('TCOM', 'COMPOSER'),
+            ('TENC', 'ENCODEDBY'),
+            ('TPUB', 'ORGANIZATION'),
+            ('TSRC', 'ISRC'),
+            ('TCMP', 'COMPILATION'),
+            ('TMED', 'MEDIA'),
+            ('COMM', 'COMMENT'))
+
+FRAME_KEYS = dict(ID3_KEYS)
+KEY_FRAMES = {4: dict(), 3: dict()}
+for frame_id, key in ID3_KEYS:
+    KEY_FRAMES[4].setdefault(key, frame_id)
+for frame_id, key in reversed(ID3_KEYS):
+    KEY_FRAMES[3].setdefault(key, frame_id)
+
+# number/total frames, split into two model keys
+ID3_PAIRS = (('TRCK', 'TRACKNUMBER', 'TRACKTOTAL'),
+             ('TPOS', 'DISCNUMBER', 'DISCTOTAL'))
+PAIR_FRAMES = {pair_id for pair_id, _, _ in ID3_PAIRS}
+
+
+class DsfHandler:
+
+    format = 'dsf'
+    suffixes = ('.dsf',)
+
+    def __init__(self, filename, meta=None, fileobj=None):
+        self.filename = filename
+        self.meta = meta if meta is not None else MetaDsf(filename)
+
+    def __file_keys(self):
+        # model key -> the frame it is read from and written back to, from
+        # the parsed tag so writing never depends on an earlier read
+        # TXXX:description is keyed by its description, frames without a
+        # model key of their own (TBPM, TCOP, TSSE ...) by their frame ID
+        # so they survive a rewrite, the first frame of a key wins (TDRC
+        # and TYER say the same)
+        keys = dict()
+        for frame_id in self.meta.get_id3_tags():
+            if frame_id.startswith('TXXX:'):
+                key = frame_id[5:].upper()
+            elif frame_id in PAIR_FRAMES:
+                continue
+            else:
+                key = FRAME_KEYS.get(frame_id, frame_id)
+            keys.setdefault(key, frame_id)
+        return keys
+
+    def read(self):
+        comment = VorbisComment()
+        id3_tags = self.meta.get_id3_tags()
+        for pair_id, number, total in ID3_PAIRS:
+            number_value, _, total_value = id3_tags.get(pair_id, '').partition('/')
+            if number_value:
+                comment[number] = [number_value]
+            if total_value:
+                comment[total] = [total_value]
+        for key, frame_id in self.__file_keys().items():
+            if key not in comment:
+                comment[key] = [id3_tags[frame_id]]
+        return comment, False, False
+
+    def stored(self):
+        return dict(self.read()[0]), set()
+
+    def fixes(self, comment):
+        changed = False
+
+        if comment.get('ENCODEDBY') == ['VinylStudio']:
+            comment.pop('ENCODEDBY', None)
+            logger.debug('Delete ENCODEDBY Tag')
+            changed = True
+
+        if comment.get('GROUPING') and comment.get('GROUPING') == comment.get('COMMENT'):
+            comment.pop('GROUPING', None)
+            logger.debug('Delete GROUPING Tag')
+            changed = True
+
+        if 'ORIGINALDATE' not in comment and comment.get('DATE'):
+            comment['ORIGINALDATE'] = comment['DATE'][:1]
+            logger.debug('Add ORIGINALDATE Tag')
+            changed = True
+
+        return changed
+
+    def frames(self, pairs):
+        # model pairs -> ID3 frame dict for MetaDsf.set_id3_tags
+        values = dict()
+        for key, value in pairs:
+            values.setdefault(key, []).append(value)
+        file_keys = self.__file_keys()
+        key_frames = KEY_FRAMES[self.meta.get_version()]
+        frames = dict()
+        for pair_id, number, total in ID3_PAIRS:
+            if number in values:
+                frames[pair_id] = values.pop(number)[0]
+                if total in values:
+                    frames[pair_id] += '/' + values.pop(total)[0]
+        for key, key_values in values.items():
+            frame_id = file_keys.get(key) or key_frames.get(key) or f'TXXX:{key}'
+            frames[frame_id] = '/'.join(key_values)
+        return frames
+
+    def write(self, pairs, padding=8192, strip_id3=False, atomic=False):
+        self.meta.set_id3_tags(self.frames(pairs))
+        self.meta.save(atomic=atomic)
+
+
+HANDLERS = {suffix: handler
+            for handler in (FlacHandler, DsfHandler)
+            for suffix in handler.suffixes}
+
+SUFFIXES = tuple(HANDLERS)
+
+
+def handler_for(filename, meta=None, fileobj=None):
+    # KeyError for a format without a handler
+    suffix = filename[filename.rfind('.'):].lower()
+    return HANDLERS[suffix](filename, meta=meta, fileobj=fileobj)
@@ -0,0 +1,146 @@
+import os
+import sys
+from array import array
+from tagmodel import handler_for
+
+# library scale tag store, for album and cross library work without
+# going back to disk
+# keys and values are dictionary encoded, each distinct string is held
+# once and tags are (key id, value id) pairs in two array columns, a
+# track's tags being the run of pairs from starts[track] to
+# starts[track + 1]; tracks are __slots__ records of folder (interned,
+# shared by the album) and file name
+# by folder lookups are kept as tracks are added, by value postings are
+# built per key on its first query
+
+MAX_KEYS = 1 << 16  # key ids are unsigned shorts
+
+
+class TrackRecord:
+
+    __slots__ = ('folder', 'name')
+
+    def __init__(self, folder, name):
+        self.folder = folder
+        self.name = name
+
+    @property
+    def path(self):
+        return os.path.join(self.folder, self.name)
+
+
+class TagStore:
+
+    def __init__(self):
+        self.records = []
+        self.__key_ids = dict()
+        self.__keys = []
+        self.__value_ids = dict()
+        self.__values = []
+        self.__key_column = array('H')
+        self.__value_column = array('L')
+        self.__starts = array('L', [0])
+        # folder -> track ids, key id -> {value id: track ids}
+        self.__by_folder = dict()
+        self.__postings = dict()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __key_id(self, key):
+        key_id = self.__key_ids.get(key)
+        if key_id is None:
+            if len(self.__keys) >= MAX_KEYS:
+                raise ValueError(f'More than {MAX_KEYS} distinct tag keys')
+            key_id = self.__key_ids[key] = len(self.__keys)
+            self.__keys.append(sys.intern(key))
+        return key_id
+
+    def __value_id(self, value):
+        value_id = self.__value_ids.get(value)
+        if value_id is None:
+            value_id = self.__value_ids[value] = len(self.__values)
+            self.__values.append(value)
+        return value_id
+
+    def add(self, path, pairs):
+        # pairs of (key, value) as comment_pairs gives them, returns the
+        # track id
+        track = len(self.records)
+        folder, name = os.path.split(path)
+        folder = sys.intern(folder)
+        self.records.append(TrackRecord(folder, name))
+        self.__by_folder.setdefault(folder, array('L')).append(track)
+        for key, value in pairs:
+            key_id = self.__key_id(key.upper())
+            value_id = self.__value_id(value)
+            self.__key_column.append(key_id)
+            self.__value_column.append(value_id)
+            postings = self.__postings.get(key_id)
+            if postings is not None:
+                postings.setdefault(value_id, array('L')).append(track)
+        self.__starts.append(len(self.__key_column))
+        return track
+
+    def path(self, track):
+        return self.records[track].path
+
+    def tags(self, track):
+        # key -> [values] of one track, like the tag model
+        tags = dict()
+        for entry in range(self.__starts[track], self.__starts[track + 1]):
+            tags.setdefault(self.__keys[self.__key_column[entry]], []).append(
+                self.__values[self.__value_column[entry]])
+        return tags
+
+    def folders(self):
+        return list(self.__by_folder)
+
+    def album(self, folder):
+        # track ids of an album folder
+        return list(self.__by_folder.get(os.path.normpath(folder), ()))
+
+    def __key_postings(self, key):
+        # value id -> track ids for one key, one pass over the columns the
+        # first time a key is queried, kept up to date by add after that
+        key_id = self.__key_ids.get(key.upper())
+        if key_id is None:
+            return dict()
+        postings = self.__postings.get(key_id)
+        if postings is None:
+            postings = self.__postings[key_id] = dict()
+            starts, keys, values = self.__starts, self.__key_column, self.__value_column
+            for track in range(len(self.records)):
+                for entry in range(starts[track], starts[track + 1]):
+                    if keys[entry] == key_id:
+                        postings.setdefault(values[entry], array('L')).append(track)
+        return postings
+
+    def find(self, key, value):
+        # track ids whose key has exactly this value
+        value_id = self.__value_ids.get(value)
+        if value_id is None:
+            return []
+        return list(self.__key_postings(key).get(value_id, ()))
+
+    def search(self, key, text, ignore_case=True):
+        # track ids with a value of key containing text, each distinct
+        # value is tested once however many tracks share it
+        if ignore_case:
+            text = text.casefold()
+        tracks = set()
+        for value_id, postings in self.__key_postings(key).items():
+            value = self.__values[value_id]
+            if text in (value.casefold() if ignore_case else value):
+                tracks.update(postings)
+        return sorted(tracks)
+
+    def counts(self):
+        # distinct keys, distinct values, tag pairs
+        return len(self.__keys), len(self.__values), len(self.__key_column)
+
+
+def tag_pairs(filename):
+    # header read of one file into (key, value) pairs
+    comment = handler_for(filename).read()[0]
+    return [(key, value) for key in comment for value in comment[key]]
@@ -0,0 +1,191 @@
+import os
+import struct
+import pytest
+from benchmark import DUMMY_AUDIO, make_flac, make_dsf
+from metaflac import MetaFlac
+from metadsf import MetaDsf
+from tagmodel import FlacHandler, DsfHandler
+from executor import ToolBatch
+from fixflactag import fix_dsf_tags, plan_tags, write_tags, write_external_flac
+
+# round trips through the native writers on generated files: the tags
+# read back are the ones written and the audio bytes are untouched
+
+COMMENTS = ['TITLE=Title', 'ARTIST=Artist', 'ALBUM=Album']
+
+
+def flac_audio(filename):
+    meta = MetaFlac(filename)
+    with open(filename, 'rb') as file:
+        file.seek(meta.get_audio_offset())
+        return file.read()
+
+
+def write_comment(filename, pairs, **save_args):
+    meta = MetaFlac(filename)
+    meta.set_vorbis_comment(pairs)
+    assert meta.save(**save_args)
+    return meta
+
+
+def assert_comment(filename, pairs):
+    comment = MetaFlac(filename).get_vorbis_comment()[0]
+    expected = dict()
+    for key, value in pairs:
+        expected.setdefault(key, []).append(value)
+    assert {key: comment[key] for key in comment} == expected
+
+
+def test_flac_in_place_within_padding(tmp_path):
+    filename = str(tmp_path / 'in_place.flac')
+    make_flac(filename, COMMENTS, padding=8192)
+    size, offset = os.path.getsize(filename), MetaFlac(filename).get_audio_offset()
+    pairs = [('TITLE', 'Title'), ('ARTIST', 'Artist'), ('COMMENT', 'x' * 1000)]
+    write_comment(filename, pairs)
+    assert_comment(filename, pairs)
+    # the padding took the growth, nothing moved
+    assert os.path.getsize(filename) == size
+    assert MetaFlac(filename).get_audio_offset() == offset
+    assert flac_audio(filename) == DUMMY_AUDIO
+
+
+def test_flac_rewrite_when_padding_runs_out(tmp_path):
+    filename = str(tmp_path / 'rewrite.flac')
+    make_flac(filename, COMMENTS, padding=64)
+    offset = MetaFlac(filename).get_audio_offset()
+    pairs = [('TITLE', 'Title'), ('COMMENT', 'x' * 4000)]
+    write_comment(filename, pairs, padding=1024)
+    assert_comment(filename, pairs)
+    meta = MetaFlac(filename)
+    assert meta.get_audio_offset() > offset
+    padding = [size for block_type, _, size in meta.get_blocks() if block_type == 1]
+    assert padding == [1024]
+    assert flac_audio(filename) == DUMMY_AUDIO
+
+
+@pytest.mark.parametrize('atomic', [False, True])
+def test_flac_strip_id3(tmp_path, atomic):
+    filename = str(tmp_path / 'id3.flac')
+    make_flac(filename, COMMENTS, id3=True)
+    assert MetaFlac(filename).has_id3_tags()
+    pairs = [('TITLE', 'Title'), ('ARTIST', 'Artist')]
+    write_comment(filename, pairs, strip_id3=True, atomic=atomic)
+    with open(filename, 'rb') as file:
+        assert file.read(4) == b'fLaC'
+    assert not MetaFlac(filename).has_id3_tags()
+    assert_comment(filename, pairs)
+    assert flac_audio(filename) == DUMMY_AUDIO
+
+
+@pytest.mark.parametrize('padding', [8192, 0])
+def test_flac_block_after_comment(tmp_path, padding):
+    # the picture follows the comment, it moves with it in place or in
+    # the rewrite
+    filename = str(tmp_path / 'picture.flac')
+    make_flac(filename, COMMENTS, picture=4096, padding=padding)
+    picture = MetaFlac(filename).get_block(6)
+    pairs = [('TITLE', 'Title'), ('COMMENT', 'x' * 2000)]
+    write_comment(filename, pairs)
+    assert_comment(filename, pairs)
+    meta = MetaFlac(filename)
+    assert meta.get_block(6) == picture
+    assert [block_type for block_type, _, _ in meta.get_blocks()][:4] == [0, 3, 4, 6]
+    assert flac_audio(filename) == DUMMY_AUDIO
+
+
+def test_external_flac_rewrites_split_and_recased(tmp_path):
+    # the metaflac edits are worked out against the comment as stored
+    filename = str(tmp_path / 'external.flac')
+    make_flac(filename, ['ARTIST=A;B', 'title=Title', 'ALBUM=Album'])
+    plan = plan_tags(FlacHandler(filename))
+    assert plan['rewrite']['ARTIST'] == ['A', 'B']
+    assert plan['rewrite']['TITLE'] == ['Title']
+    batch = ToolBatch()
+    write_external_flac(plan, batch)
+    (_, [(head, files)]), = batch.steps()
+    assert files == [filename]
+    assert head[head.index('--remove-tag=ARTIST'):][:3] == \
+        ['--remove-tag=ARTIST', '--set-tag=ARTIST=A', '--set-tag=ARTIST=B']
+    assert '--set-tag=TITLE=Title' in head
+
+
+def dsf_audio(filename):
+    meta = MetaDsf(filename)
+    with open(filename, 'rb') as file:
+        file.seek(meta.get_audio_offset())
+        return file.read(meta.get_audio_size())
+
+
+@pytest.mark.parametrize('atomic', [False, True])
+def test_dsf_rewrite_tag(tmp_path, atomic):
+    filename = str(tmp_path / 'tagged.dsf')
+    make_dsf(filename, 1, 1)
+    tags = MetaDsf(filename).get_id3_tags()
+    tags.pop('TENC')
+    tags['TIT2'] = 'New title'
+    tags['TXXX:TRACKTOTAL'] = '09'
+    meta = MetaDsf(filename)
+    meta.set_id3_tags(tags)
+    assert meta.save(atomic=atomic)
+    assert MetaDsf(filename).get_id3_tags() == tags
+    assert dsf_audio(filename) == DUMMY_AUDIO
+
+
+EXTRA_FRAMES = {'TBPM': '120', 'TCOP': '1999 Label', 'TSSE': 'Encoder',
+                'TKEY': 'Am', 'TPE3': 'Conductor', 'TXXX:Label': 'Label'}
+
+
+def make_dsf_extra(filename):
+    # frames the tag model has no key of its own for
+    make_dsf(filename, 1, 1)
+    meta = MetaDsf(filename)
+    meta.set_id3_tags(dict(meta.get_id3_tags(), **EXTRA_FRAMES))
+    meta.save()
+
+
+def test_dsf_fix_keeps_unmapped_frames(tmp_path):
+    filename = str(tmp_path / 'extra.dsf')
+    make_dsf_extra(filename)
+    assert fix_dsf_tags(filename)
+    tags = MetaDsf(filename).get_id3_tags()
+    assert 'TENC' not in tags
+    assert {frame_id: tags.get(frame_id) for frame_id in EXTRA_FRAMES} == EXTRA_FRAMES
+    assert dsf_audio(filename) == DUMMY_AUDIO
+
+
+def test_dsf_apply_keeps_frame_ids(tmp_path):
+    # a plan written by a fresh handler, as --apply does, goes back to the
+    # frames the file has
+    filename = str(tmp_path / 'apply.dsf')
+    make_dsf_extra(filename)
+    plan = plan_tags(DsfHandler(filename))
+    assert ('LABEL', 'Label') in plan['tags']
+    write_tags(plan)
+    tags = MetaDsf(filename).get_id3_tags()
+    assert 'TXXX:LABEL' not in tags
+    assert {frame_id: tags.get(frame_id) for frame_id in EXTRA_FRAMES} == EXTRA_FRAMES
+    assert dsf_audio(filename) == DUMMY_AUDIO
+
+
+def test_dsf_without_tag(tmp_path):
+    filename = str(tmp_path / 'untagged.dsf')
+    make_dsf(filename, 1, 1)
+    # cut the tag off and clear the metadata pointer
+    with open(filename, 'r+b') as file:
+        header = file.read(28)
+        metadata_offset = struct.unpack('<Q', header[20:28])[0]
+        file.truncate(metadata_offset)
+        file.seek(12)
+        file.write(struct.pack('<QQ', metadata_offset, 0))
+    meta = MetaDsf(filename)
+    assert meta.get_id3_tags() == dict()
+    assert dsf_audio(filename) == DUMMY_AUDIO
+    meta.set_id3_tags({'TIT2': 'Title', 'TPE1': 'Artist'})
+    assert meta.save()
+    assert MetaDsf(filename).get_id3_tags() == {'TIT2': 'Title', 'TPE1': 'Artist'}
+    with open(filename, 'rb') as file:
+        header = file.read(28)
+    file_size, pointer = struct.unpack('<QQ', header[12:28])
+    assert pointer == metadata_offset
+    assert file_size == os.path.getsize(filename)
+    assert dsf_audio(filename) == DUMMY_AUDIO
@@ -0,0 +1,70 @@
+import io
+import mmap
+import random
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from tagmodel import handler_for
+
+# audio integrity check around tag writes, no decoding
+# the sample data (FLAC frames from the end of the last metadata block
+# to the end of the file, the DSF data chunk) is hashed before and after
+# a write, the digests must match however far the write moved the audio
+# BLAKE2b over an mmap of the file in chunks, hashlib drops the GIL
+# while hashing so threads check files in parallel
+# sampled mode hashes the first and last extent plus N more at offsets
+# seeded by the audio size, so both hashes cover the same bytes
+
+CHUNK = 8 << 20
+EXTENT = 1 << 20
+
+
+def audio_extents(size, samples=0, extent=EXTENT):
+    # (start, length) pairs relative to the start of the audio
+    if not samples or (samples + 2) * extent >= size:
+        return [(0, size)]
+    starts = random.Random(size).sample(range(extent, size - 2 * extent), samples)
+    return [(start, extent) for start in [0] + sorted(starts) + [size - extent]]
+
+
+def audio_digest(filename, offset, size, samples=0):
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(size.to_bytes(8, 'little'))
+    if size <= 0:
+        return digest.hexdigest()
+    with io.open(filename, 'rb') as file, \
+         mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        if hasattr(view, 'madvise') and not samples:
+            view.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(view) as buffer:
+            for start, length in audio_extents(size, samples):
+                pos = offset + start
+                end = pos + length
+                while pos < end:
+                    step = min(CHUNK, end - pos)
+                    digest.update(buffer[pos:pos + step])
+                    pos += step
+    return digest.hexdigest()
+
+
+def meta_audio_digest(meta, samples=0):
+    # from a parser already holding the file's headers
+    return audio_digest(meta.filename, meta.get_audio_offset(),
+                        meta.get_audio_size(), samples)
+
+
+def file_audio_digest(filename, samples=0):
+    # headers parsed afresh, e.g. after a write
+    return meta_audio_digest(handler_for(filename).meta, samples)
+
+
+def verify_files(expected, samples=0, jobs=4):
+    # {filename: digest before} -> filenames whose audio no longer matches
+    def check(filename):
+        try:
+            return file_audio_digest(filename, samples) != expected[filename]
+        except Exception:
+            return True  # unreadable after the write counts as changed
+
+    with ThreadPoolExecutor(jobs) as pool:
+        return [filename for filename, changed in
+                zip(expected, pool.map(check, expected)) if changed]
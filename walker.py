@@ -0,0 +1,32 @@
+import os
+from tagmodel import SUFFIXES
+
+# streaming library walk, a single os.scandir pass yields the files of
+# every format with a tag handler as they are found, album directory by
+# album directory
+
+
+def walk_library(folder, depth=3, suffixes=SUFFIXES):
+    # depth is how many directory levels below folder are searched,
+    # entries are sorted within each directory so the order is stable
+    try:
+        with os.scandir(folder) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except OSError:
+        return
+
+    subfolders = []
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+        try:
+            if entry.is_dir():
+                subfolders.append(entry.path)
+            elif entry.name.lower().endswith(suffixes) and entry.is_file():
+                yield entry.path
+        except OSError:
+            pass
+
+    if depth > 0:
+        for subfolder in subfolders:
+            yield from walk_library(subfolder, depth - 1, suffixes)
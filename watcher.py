@@ -0,0 +1,170 @@
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import time
+from walker import SUFFIXES
+
+logger = logging.getLogger('fixflactag.watcher')
+
+# Linux inotify watch of a library, every directory below the root is
+# watched, files written or moved in are collected per album directory
+# and handed out once the directory has been quiet for settle seconds
+# inotify is reached through libc with ctypes, there is no dependency
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+EVENT = struct.Struct('iIII')
+
+
+class LibraryWatcher:
+
+    def __init__(self, folder, settle=5.0, depth=3, suffixes=SUFFIXES):
+        self.folder = folder
+        self.settle = settle
+        self.depth = depth
+        self.suffixes = suffixes
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self.__add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available on this platform')
+        self.__add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.__fd = init(IN_CLOEXEC)
+        if self.__fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # watch descriptor -> (directory, depth below the root)
+        self.__watches = dict()
+        # album directory -> (last event time, paths)
+        self.__pending = dict()
+        # path -> stat when last processed, our own writes are ignored
+        self.__settled = dict()
+        self.__poller = select.poll()
+        self.__poller.register(self.__fd, select.POLLIN)
+        self.__watch_tree(folder, depth)
+
+    def close(self):
+        os.close(self.__fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __watch_tree(self, folder, depth, queue=False):
+        # queue also picks up the wanted files already there, a new
+        # directory can fill up before its watch is in place
+        wd = self.__add_watch(self.__fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            logger.warning(f'Cannot watch "{folder}": {os.strerror(err)}')
+            return
+        self.__watches[wd] = (folder, depth)
+        try:
+            with os.scandir(folder) as it:
+                entries = list(it)
+        except OSError:
+            return
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            if is_dir and depth > 0:
+                self.__watch_tree(entry.path, depth - 1, queue)
+            elif queue and not is_dir:
+                self.__queue(entry.path)
+
+    def __queue(self, path):
+        if not path.lower().endswith(self.suffixes):
+            return
+        folder = os.path.dirname(path)
+        _, paths = self.__pending.get(folder, (0, set()))
+        paths.add(path)
+        self.__pending[folder] = (time.monotonic(), paths)
+
+    def __read_events(self):
+        data = os.read(self.__fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, pos)
+            name = data[pos + EVENT.size:pos + EVENT.size + length].rstrip(b'\0')
+            pos += EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                logger.warning('inotify queue overflowed, events were lost, '
+                               'run a full pass to catch up')
+                continue
+            if mask & IN_IGNORED:
+                self.__watches.pop(wd, None)
+                continue
+            if wd not in self.__watches or not name:
+                continue
+            folder, depth = self.__watches[wd]
+            name = os.fsdecode(name)
+            if name.startswith('.'):
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if depth > 0:
+                    # a new album, or one moved in whole
+                    self.__watch_tree(path, depth - 1, queue=True)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.__queue(path)
+
+    def __stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def settled(self, paths):
+        # record files just processed, the events their writes cause
+        # are then recognised and dropped
+        for path in paths:
+            self.__settled[path] = self.__stat(path)
+
+    def batches(self):
+        # yields the sorted paths of one album directory at a time, only
+        # files that still exist and changed since we last touched them
+        while True:
+            now = time.monotonic()
+            for folder, (last, paths) in sorted(self.__pending.items()):
+                if now - last < self.settle:
+                    continue
+                del self.__pending[folder]
+                ready = []
+                for path in sorted(paths):
+                    current = self.__stat(path)
+                    # temp files of a rewrite are gone by now
+                    if current is None or self.__settled.get(path) == current:
+                        continue
+                    ready.append(path)
+                if ready:
+                    yield ready
+
+            if self.__pending:
+                wait = (min(last for last, _ in self.__pending.values())
+                        + self.settle - time.monotonic())
+                timeout = max(0, int(wait * 1000)) + 1
+            else:
+                timeout = None
+            if self.__poller.poll(timeout):
+                self.__read_events()